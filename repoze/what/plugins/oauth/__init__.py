@@ -1,7 +1,7 @@
 from paste.request import parse_dict_querystring
 from repoze.what.predicates import Predicate
 
-from repoze.who.plugins.oauth import DefaultManager
+from repoze.who.plugins.oauth import DefaultManager, PARAMS_KEY
 
 
 class is_consumer(Predicate):
@@ -144,8 +144,13 @@ class token_authorization(Predicate):
             - verifier - an authorization verification code (when the user agent
               is not a browser)
             - url - a URL to redirect to (if the user agent is a browser)
+
+            Returns None if the token is not found, is outdated or has been
+            authorized by another user already.
             """
             token = self.manager.set_request_token_user(token_key, userid)
+            if token is None:
+                return
             return dict(
                 verifier=token.verifier,
                 url=token.callback_url,
@@ -157,8 +162,11 @@ class token_authorization(Predicate):
             environ['repoze.what.oauth'] = {}
         what_env = environ['repoze.what.oauth']
         if environ['REQUEST_METHOD'] == 'GET':
-            # Look for a token using the given oauth_token key
-            params = parse_dict_querystring(environ)
+            # Look for a token using the given oauth_token key. Reuse the
+            # parameters parsed by the repoze.who plugin if available
+            params = environ.get(PARAMS_KEY)
+            if params is None:
+                params = parse_dict_querystring(environ)
             token_key = params.get('oauth_token')
             if not token_key:
                 # Token key not given
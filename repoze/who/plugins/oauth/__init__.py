@@ -1,5 +1,10 @@
-from plugin import OAuthPlugin
+from plugin import OAuthPlugin, PARAMS_KEY, REQUEST_KEY, TIMINGS_KEY
 
 from managers import DefaultManager
 
+from metrics import MetricsRegistry
+
+from nonces import (NonceStore, MemoryNonceStore, BloomNonceStore,
+    SQLNonceStore)
+
 from model import Consumer, RequestToken, AccessToken
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LRUCache(object):
+    r"""A thread safe in-process cache with a bounded size and per-entry time
+    to live. The least recently used entries are evicted first when the cache
+    is full.
+
+    For initialization it takes:
+    - size - the maximum number of entries to keep. 0 disables the cache.
+    - ttl - the default number of seconds an entry stays valid. None means
+      entries never expire (but can still be evicted).
+    - timer - (optional) a function returning the current time in seconds.
+      Default - time.time.
+    """
+
+    def __init__(self, size=1000, ttl=None, timer=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = Lock()
+        # Lookup statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        r"""Return the value stored under the key or default if the key is not
+        cached or has expired"""
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self.timer():
+                # Outdated - forget it
+                self.misses += 1
+                return default
+            # Put the entry back as the most recently used one
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        r"""Store the value under the key. The ttl overrides the default time to
+        live of the cache for this entry."""
+        if not self.size:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = self.timer() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            # Evict the least recently used entries
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        r"""Forget the entry stored under the key (if any)"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        r"""Forget all the entries. The statistics are reset too"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<%s %s/%s hits=%s misses=%s>' % (self.__class__.__name__,
+            len(self._data), self.size, self.hits, self.misses)
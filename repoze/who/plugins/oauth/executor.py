@@ -0,0 +1,112 @@
+r"""A worker pool to take the CPU heavy signature checks off the request
+threads."""
+import binascii
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Lock
+
+
+def _run(func, args):
+    r"""Run the function in a worker. Never raises so that the completion is
+    always reported back"""
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, e
+
+
+def rsa_verify(n, e, data, signature):
+    r"""Verify the RSA signature (a long) of the data (the padded digest) with
+    the public key (n, e). Pure python, so that it can run in any process"""
+    if not 0 <= signature < n:
+        return False
+    return pow(signature, e, n) == long(binascii.hexlify(data) or '0', 16)
+
+
+class VerificationExecutor(object):
+    r"""Runs functions in a pool of worker processes (or threads) and waits
+    for their results with a timeout. The pool is started on first use (and
+    restarted in forked processes).
+
+    For initialization it takes:
+    - workers - (optional) the number of workers. Default - 2.
+    - timeout - (optional) the number of seconds to wait for a result.
+      Default - 5.
+    - processes - (optional) use worker processes. Otherwise threads are used -
+      these help only with the backends releasing the GIL. Default - True.
+
+    The queue depth metrics:
+    - depth - the number of calls submitted but not completed yet.
+    - max_depth - the largest depth seen.
+    - submitted, completed - the number of calls submitted and completed.
+    - timeouts - the number of calls not completed within the timeout.
+    - errors - the number of calls that raised.
+    """
+
+    def __init__(self, workers=2, timeout=5, processes=True):
+        self.workers = workers
+        self.timeout = timeout
+        self.processes = processes
+        self._pool = None
+        self._pid = None
+        self._lock = Lock()
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def _get_pool(self):
+        r"""Return the pool of this process, start one if needed"""
+        if self._pid != os.getpid():
+            # Do not use the workers of the parent process (nor count its
+            # calls in flight)
+            self._pool = (Pool if self.processes else ThreadPool)(self.workers)
+            self._pid = os.getpid()
+            self.depth = 0
+        return self._pool
+
+    def _done(self, result):
+        r"""Account a completed call (runs in the pool result thread)"""
+        with self._lock:
+            self.depth -= 1
+            self.completed += 1
+            if not result[0]:
+                self.errors += 1
+
+    def call(self, func, *args):
+        r"""Run func(*args) in the pool and return its result. Raises
+        multiprocessing.TimeoutError if the call does not complete within the
+        timeout. Exceptions raised by func are raised here"""
+        with self._lock:
+            pool = self._get_pool()
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.submitted += 1
+        result = pool.apply_async(_run, (func, args), callback=self._done)
+        try:
+            ok, value = result.get(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        if not ok:
+            raise value
+        return value
+
+    def stats(self):
+        r"""Return the queue depth metrics as a dict"""
+        with self._lock:
+            return dict(depth=self.depth, max_depth=self.max_depth,
+                submitted=self.submitted, completed=self.completed,
+                timeouts=self.timeouts, errors=self.errors)
+
+    def close(self):
+        r"""Stop the workers"""
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self._pid = None
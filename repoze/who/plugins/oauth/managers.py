@@ -1,13 +1,75 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
+from weakref import WeakSet
 
+from paste.util.converters import asbool
 import sqlalchemy as sa
 from sqlalchemy import orm
 
-from .model import Consumer, RequestToken, AccessToken
+from .cache import LRUCache
+from .model import (Consumer, RequestToken, AccessToken, gen_random_string,
+    _make_detached)
+from .sweeper import TokenSweeper
+
+
+# A marker for the unsuccessful lookups in the caches
+_not_found = object()
+
+# SQLite engines that have foreign key enforcement turned on
+_sqlite_fk_engines = WeakSet()
+
+
+def _enable_sqlite_foreign_keys(engine):
+    r"""SQLite ignores foreign keys (and therefore ON DELETE CASCADE) unless
+    asked otherwise on every connection"""
+    if engine.dialect.name != 'sqlite' or engine in _sqlite_fk_engines \
+            or not hasattr(sa, 'event'):
+        return
+
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+    sa.event.listen(engine, 'connect', on_connect)
+    _sqlite_fk_engines.add(engine)
+
+
+def _optional_float(value):
+    r"""Convert the value to float. None, empty and 'none' strings (as given
+    in the config files) mean None"""
+    if value is None or isinstance(value, basestring) and \
+            value.strip().lower() in ('', 'none'):
+        return None
+    return float(value)
 
 
 class DefaultManager(object):
     """A manager that takes care of the consumer and tokens in database.
+
+    For initialization it takes:
+    - engine - an SQLAlchemy database engine or a engine url.
+    - consumer_cache_size - (optional) the maximum number of consumers to keep
+      in the in-process consumer cache. 0 disables the cache. Default - 1000.
+    - consumer_cache_ttl - (optional) the number of seconds a cached consumer is
+      trusted before it is fetched from the database again. Default - 60.
+    - access_token_cache_size - (optional) the maximum number of access token
+      lookups to keep in the in-process access token cache. 0 disables the
+      cache. Default - 10000.
+    - access_token_cache_ttl - (optional) the number of seconds a cached access
+      token is trusted. Tokens with valid_till set are never cached past it.
+      Default - 60.
+    - access_token_negative_ttl - (optional) the number of seconds a failed
+      access token lookup is remembered. Default - 5.
+    - sweep_interval - (optional) the number of seconds between the expired
+      token sweeps in a background thread. None disables the thread (call
+      sweep_expired_tokens yourself then). Default - None.
+    - sweep_batch_size - (optional) the maximum number of tokens deleted by a
+      single statement of the sweep. Default - 1000.
+    - stale_request_token_age - (optional) the number of seconds after which
+      request tokens not authorized by any user get swept. None keeps them.
+      Default - 86400.
+    - consumer_rsa_keys - (optional) add the rsa_key column to the consumers
+      table to store the PEM encoded RSA public keys of the RSA-SHA1 consumers
+      in. Default - False.
     """
 
     # Default tables to store the consumer and token data. Replace these tables
@@ -16,15 +78,25 @@ class DefaultManager(object):
     RequestToken = RequestToken
     AccessToken = AccessToken
 
-    def __init__(self, engine):
+    def __init__(self, engine, consumer_cache_size=1000, consumer_cache_ttl=60,
+            access_token_cache_size=10000, access_token_cache_ttl=60,
+            access_token_negative_ttl=5, sweep_interval=None,
+            sweep_batch_size=1000, stale_request_token_age=86400,
+            consumer_rsa_keys=False):
         if not isinstance(engine, sa.engine.base.Engine):
             engine = sa.create_engine(engine)
+        # Tokens are deleted together with their consumer by the database
+        _enable_sqlite_foreign_keys(engine)
 
         # Create a scoped session for database record management. It has
         # autocommit set which basically means all changes are committed on
         # flush
         self.DBSession = orm.scoped_session(
             orm.sessionmaker(autoflush=False, autocommit=True, bind=engine))
+        # A session factory to load the objects that will be cached. The
+        # objects get detached when the session is closed
+        self.CacheSession = orm.sessionmaker(autoflush=False, autocommit=True,
+            bind=engine)
         # Create a metadata
         self.metadata = sa.MetaData(bind=engine)
 
@@ -33,6 +105,11 @@ class DefaultManager(object):
         self.RequestToken.metadata = self.metadata
         self.AccessToken.metadata = self.metadata
 
+        # The RSA public keys of the consumers. Old tables have to be altered
+        # to have the column
+        if asbool(consumer_rsa_keys) and not hasattr(self.Consumer, 'rsa_key'):
+            self.Consumer.rsa_key = sa.Column(sa.types.Text())
+
         # Allow the subclasses to modify the tables before creation
         self.modify_tables()
         # Setup relationships between tables
@@ -45,6 +122,77 @@ class DefaultManager(object):
             self.AccessToken.__table__,
         ], checkfirst=True)
 
+        # Consumers rarely change but are needed on every request. Keep them in
+        # a read-through cache
+        self.consumer_cache = LRUCache(size=int(consumer_cache_size),
+            ttl=float(consumer_cache_ttl))
+        # Access tokens are needed on every 3-legged request. Cache them as well
+        # as the unsuccessful lookups (e.g. revoked tokens)
+        self.access_token_cache = LRUCache(size=int(access_token_cache_size),
+            ttl=float(access_token_cache_ttl))
+        self.access_token_negative_ttl = float(access_token_negative_ttl)
+
+        # Expired token sweeping
+        self.sweep_batch_size = int(sweep_batch_size)
+        self.stale_request_token_age = _optional_float(
+            stale_request_token_age)
+        # The number of tokens deleted by the last sweep
+        self.last_sweep = None
+        # The database query time histogram (see register_metrics)
+        self.query_time = None
+        self.sweeper = None
+        sweep_interval = _optional_float(sweep_interval)
+        if sweep_interval:
+            self.sweeper = TokenSweeper(self, sweep_interval)
+            self.sweeper.start()
+
+
+    def register_metrics(self, metrics):
+        r"""Report the cache statistics and the database query times in the
+        MetricsRegistry"""
+        caches = dict(consumer=self.consumer_cache,
+            access_token=self.access_token_cache)
+        def cache_stat(stat):
+            return lambda: dict(((name,), stat(cache))
+                for name, cache in caches.items())
+        def hit_ratio(cache):
+            lookups = cache.hits + cache.misses
+            return float(cache.hits) / lookups if lookups else 0.0
+        metrics.callback('oauth_cache_hits_total', 'Cache lookups found.',
+            cache_stat(lambda cache: cache.hits), labels=('cache',),
+            type='counter')
+        metrics.callback('oauth_cache_misses_total', 'Cache lookups missed.',
+            cache_stat(lambda cache: cache.misses), labels=('cache',),
+            type='counter')
+        metrics.callback('oauth_cache_hit_ratio',
+            'The ratio of the cache lookups found.', cache_stat(hit_ratio),
+            labels=('cache',))
+        metrics.callback('oauth_cache_entries', 'Cache entries.',
+            cache_stat(len), labels=('cache',))
+
+        installed = self.query_time is not None
+        self.query_time = metrics.histogram('oauth_db_query_seconds',
+            'Database query time in seconds.', labels=('statement',))
+        if installed or not hasattr(sa, 'event'):
+            return
+        engine = self.metadata.bind
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                executemany):
+            if context is not None:
+                context._oauth_query_start = time.time()
+
+        def after_execute(conn, cursor, statement, parameters, context,
+                executemany):
+            start = getattr(context, '_oauth_query_start', None)
+            if start is not None:
+                # Label by the statement kind (SELECT, INSERT, ...)
+                self.query_time.observe(time.time() - start,
+                    (statement.split(None, 1)[0].upper(),))
+
+        sa.event.listen(engine, 'before_cursor_execute', before_execute)
+        sa.event.listen(engine, 'after_cursor_execute', after_execute)
+
 
     def modify_tables(self):
         """Modify the Consumer and Token tables.
@@ -55,29 +203,79 @@ class DefaultManager(object):
     def setup_relationships(self):
         """Setup relationships between the Consumer and Token tables. May be
         overridden to add/modify the relationships"""
-        # Set consumer key columns for request and access tokens
+        # Set consumer key columns for request and access tokens. The tokens
+        # are deleted by the database when their consumer gets deleted
         if not hasattr(self.RequestToken, 'consumer_key'):
             self.RequestToken.consumer_key = sa.Column(sa.ForeignKey(
-                self.Consumer.key))
+                self.Consumer.key, ondelete='CASCADE'))
         if not hasattr(self.AccessToken, 'consumer_key'):
             self.AccessToken.consumer_key = sa.Column(sa.ForeignKey(
-                self.Consumer.key))
+                self.Consumer.key, ondelete='CASCADE'))
         # Create collections of request and access tokens for the consumer. The
-        # relationship is ON CASCADE DELETE
+        # relationship is ON CASCADE DELETE. The collections are dynamic (i.e.
+        # queries) so that appending a new token does not load all the tokens
+        # of the consumer. The deletes are passive - the ORM leaves the cascade
+        # to the database instead of loading and deleting the tokens one by one
         if not hasattr(self.Consumer, 'request_tokens'):
             self.Consumer.request_tokens = orm.relation(self.RequestToken,
                 backref=orm.backref('consumer'),
-                cascade='all, delete, delete-orphan')
+                cascade='all, delete, delete-orphan', lazy='dynamic',
+                passive_deletes=True)
         if not hasattr(self.Consumer, 'access_tokens'):
             self.Consumer.access_tokens = orm.relation(self.AccessToken,
                 backref=orm.backref('consumer'),
-                cascade='all, delete, delete-orphan')
+                cascade='all, delete, delete-orphan', lazy='dynamic',
+                passive_deletes=True)
 
 
     def get_consumer_by_key(self, key):
-        r"""Fetch a consumer by the given key. None if not found"""
-        cons = self.DBSession.query(self.Consumer).filter_by(key=key).first()
-        return cons
+        r"""Fetch a consumer by the given key. None if not found.
+        Consumers are looked up in the consumer cache first. The cache keeps
+        detached copies loaded in a separate session so that they survive the
+        commits (and expiration) of DBSession. The caller gets a copy merged
+        into DBSession.
+        """
+        if not self.consumer_cache.size:
+            return self.DBSession.query(self.Consumer).filter_by(
+                key=key).first()
+
+        cons = self.consumer_cache.get(key)
+        if cons is None:
+            session = self.CacheSession()
+            cons = session.query(self.Consumer).filter_by(key=key).first()
+            session.close()
+            if cons is None:
+                return
+            self.consumer_cache.set(key, cons)
+        return self._merge_cached(cons)
+
+    def delete_consumer(self, key):
+        r"""Delete the consumer and (by the database cascade) all of its tokens
+        with a single statement. Returns True if the consumer existed.
+        The cached access token lookups of the consumer are not found through
+        the plugin any more as the consumer is looked up first. They expire
+        within access_token_cache_ttl.
+        """
+        result = self.DBSession.execute(self.Consumer.__table__.delete(
+            self.Consumer.__table__.c.key == key))
+        self.invalidate_consumer(key)
+        return result.rowcount > 0
+
+    def invalidate_consumer(self, key):
+        r"""Remove the consumer from the consumer cache. Call this after
+        modifying or deleting the consumer outside of the manager."""
+        self.consumer_cache.invalidate(key)
+
+    def invalidate_access_token(self, key, consumer_key):
+        r"""Remove the access token lookup (successful or not) from the access
+        token cache. Call this after modifying or deleting the token outside of
+        the manager."""
+        self.access_token_cache.invalidate((key, consumer_key))
+
+    def clear(self):
+        r"""Empty the manager caches"""
+        self.consumer_cache.clear()
+        self.access_token_cache.clear()
 
 
     def create_request_token(self, consumer, callback):
@@ -91,56 +289,252 @@ class DefaultManager(object):
         r"""Create a new access token using the given request token.
         The consumer and user id are copied from the request token.
         The request token is then deleted.
+        The exchange is atomic - the request token is consumed by a conditional
+        DELETE and the access token is inserted in the same transaction. If the
+        request token has already been consumed (e.g. by a concurrent exchange)
+        or is not authorized by a user then None is returned.
         """
-        atoken = self.AccessToken.create(consumer=rtoken.consumer,
-            userid=rtoken.userid, session=self.DBSession)
-        self.DBSession.delete(rtoken)
-        self.DBSession.flush()
+        session = self.DBSession
+        rtable = self.RequestToken.__table__
+        atable = self.AccessToken.__table__
+        # Take the values before the request token is gone
+        rtoken_key, consumer_key, userid = rtoken.key, rtoken.consumer_key, \
+            rtoken.userid
+        if userid is None:
+            return
+        values = dict(key=gen_random_string(length=40),
+            secret=gen_random_string(length=40), userid=userid,
+            consumer_key=consumer_key)
+        attempt = 1
+        while True:
+            session.begin(subtransactions=True)
+            try:
+                consumed = session.execute(rtable.delete(sa.and_(
+                    rtable.c.key == rtoken_key,
+                    rtable.c.userid == userid))).rowcount
+                if consumed != 1:
+                    # Somebody else got here first
+                    session.rollback()
+                    return
+                session.execute(atable.insert(), values)
+                session.commit()
+            except sa.exc.IntegrityError:
+                session.rollback()
+                if attempt >= self.AccessToken.max_key_attempts:
+                    raise
+                # An access token with this key already exists. Try a new key
+                values['key'] = gen_random_string(length=40)
+                attempt += 1
+            except:
+                session.rollback()
+                raise
+            else:
+                break
+
+        if rtoken in session:
+            session.expunge(rtoken)
+        atoken = self.AccessToken._attach_token(session, **values)
+        # Forget a failed lookup of this token, if any
+        self.invalidate_access_token(atoken.key, consumer_key)
         return atoken
 
+    def delete_access_token(self, token):
+        r"""Delete (revoke) the access token"""
+        self.DBSession.delete(token)
+        self.DBSession.flush()
+        self.invalidate_access_token(token.key, token.consumer_key)
+
+    def _live(self, token):
+        r"""Return the token unless it is outdated (valid_till is in the past).
+        Tokens having valid_till NULL (or no valid_till at all) are assumed to
+        be permanent (never outdating).
+        The check is done on the loaded token so that the token queries stay
+        plain primary key lookups.
+        """
+        valid_till = getattr(token, 'valid_till', None)
+        if valid_till is not None and valid_till <= datetime.now():
+            return
+        return token
+
     def get_request_token(self, key):
         r"""Fetch a request token by the given key. None if not found.
         If 'valid_till' is set for the token it is checked to be not earlier
         than now.
         """
-        tokens = self.DBSession.query(self.RequestToken).filter_by(key=key)
-        # If request token has a valid_till column...
-        if hasattr(self.RequestToken, 'valid_till'):
-            now = datetime.now()
-            # ... filter out outdated tokens. Those having valid_till NULL are
-            # assumed to be permanent (never outdating)
-            tokens = tokens.filter((self.RequestToken.valid_till == None) |
-                (self.RequestToken.valid_till <= now))
-        token = tokens.first()
-        return token
+        token = self.DBSession.query(self.RequestToken).filter_by(
+            key=key).first()
+        return self._live(token)
 
     def get_access_token(self, key, consumer):
         r"""Fetch an access token by the given key and consumer. None if not
         found.
         If 'valid_till' is set for the token it is checked to be not earlier
         than now.
+        The lookups (including the unsuccessful ones) are cached in the access
+        token cache.
         """
-        tokens = self.DBSession.query(self.AccessToken).filter_by(key=key,
-            consumer_key=consumer.key)
-        # If access token has a valid_till column...
-        if hasattr(self.AccessToken, 'valid_till'):
-            now = datetime.now()
-            # ... filter out outdated tokens. Those having valid_till NULL are
-            # assumed to be permanent (never outdating)
-            tokens = tokens.filter((self.AccessToken.valid_till == None) |
-                (self.AccessToken.valid_till <= now))
-        token = tokens.first()
+        if not self.access_token_cache.size:
+            return self._query_access_token(self.DBSession, key, consumer.key)
+
+        cache_key = (key, consumer.key)
+        token = self.access_token_cache.get(cache_key)
+        if token is None:
+            session = self.CacheSession()
+            token = self._query_access_token(session, key, consumer.key)
+            session.close()
+            token = self._cache_access_token(cache_key, token)
+        return self._merge_cached(token)
+
+    def get_consumer_and_access_token(self, consumer_key, token_key):
+        r"""Fetch a consumer and its access token by the given keys using a
+        single query. Returns a (consumer, token) tuple where the consumer is
+        None if not found and the token is None if not found (the same way as
+        get_consumer_by_key and get_access_token would find them).
+        The consumer and access token caches are consulted and updated.
+        """
+        consumer_cache = self.consumer_cache
+        token_cache = self.access_token_cache
+        if not (consumer_cache.size or token_cache.size):
+            return self._query_consumer_and_access_token(self.DBSession,
+                consumer_key, token_key)
+
+        cache_key = (token_key, consumer_key)
+        consumer = consumer_cache.get(consumer_key)
+        token = token_cache.get(cache_key)
+        if consumer is None or token is None:
+            session = self.CacheSession()
+            loaded_consumer, loaded_token = \
+                self._query_consumer_and_access_token(session, consumer_key,
+                    token_key)
+            session.close()
+            if loaded_consumer is None:
+                return None, None
+            if consumer is None:
+                consumer = loaded_consumer
+                consumer_cache.set(consumer_key, consumer)
+            if token is None:
+                token = self._cache_access_token(cache_key, loaded_token)
+        return self._merge_cached(consumer), self._merge_cached(token)
+
+    def _query_access_token(self, session, key, consumer_key):
+        r"""Query the database for an access token by the given key and
+        consumer key"""
+        token = session.query(self.AccessToken).filter_by(key=key,
+            consumer_key=consumer_key).first()
+        return self._live(token)
+
+    def _query_consumer_and_access_token(self, session, consumer_key,
+            token_key):
+        r"""Query the database for a consumer and its access token in one go.
+        The access token is outer joined so that the consumer is found even if
+        the token is not"""
+        onclause = sa.and_(self.AccessToken.consumer_key == self.Consumer.key,
+            self.AccessToken.key == token_key)
+        row = session.query(self.Consumer, self.AccessToken).outerjoin(
+            (self.AccessToken, onclause)).filter(
+            self.Consumer.key == consumer_key).first()
+        if row is None:
+            return None, None
+        return row[0], self._live(row[1])
+
+    def _cache_access_token(self, cache_key, token):
+        r"""Store the access token lookup result in the access token cache and
+        return what was stored"""
+        cache = self.access_token_cache
+        if token is None:
+            # Remember the failure for a short while
+            cache.set(cache_key, _not_found, ttl=self.access_token_negative_ttl)
+            return _not_found
+        ttl = cache.ttl
+        valid_till = getattr(token, 'valid_till', None)
+        if valid_till is not None:
+            # Do not trust the cached token longer than it is valid
+            left = valid_till - datetime.now()
+            ttl = min(ttl, left.days * 86400 + left.seconds)
+        if ttl > 0:
+            cache.set(cache_key, token, ttl=ttl)
         return token
 
+    def _merge_cached(self, obj):
+        r"""Merge a cached (detached) object into DBSession. Merging without
+        load does not touch the database"""
+        if obj is None or obj is _not_found:
+            return
+        return self.DBSession.merge(obj, load=False)
+
+    def sweep_expired_tokens(self):
+        r"""Delete the tokens past their valid_till and the stale request tokens
+        not authorized by any user. The tokens are deleted in batches of
+        sweep_batch_size so that no statement runs for long.
+        Returns (and remembers in last_sweep) a dict with the number of deleted
+        request_tokens, stale_request_tokens and access_tokens.
+        """
+        now = datetime.now()
+        swept = dict(request_tokens=0, stale_request_tokens=0, access_tokens=0)
+        for name, Token in (('request_tokens', self.RequestToken),
+                ('access_tokens', self.AccessToken)):
+            if hasattr(Token, 'valid_till'):
+                swept[name] = self._delete_in_batches(Token,
+                    Token.valid_till <= now)
+        if self.stale_request_token_age is not None and \
+                hasattr(self.RequestToken, 'created'):
+            Token = self.RequestToken
+            created_before = now - timedelta(
+                seconds=self.stale_request_token_age)
+            swept['stale_request_tokens'] = self._delete_in_batches(Token,
+                sa.and_(Token.userid == None, Token.created < created_before))
+        self.last_sweep = swept
+        return swept
+
+    def _delete_in_batches(self, Token, condition):
+        r"""Delete the tokens matching the condition sweep_batch_size at a time.
+        Returns the number of the deleted tokens"""
+        table = Token.__table__
+        deleted = 0
+        while True:
+            keys = [row[0] for row in self.DBSession.execute(
+                sa.select([table.c.key], condition).limit(
+                    self.sweep_batch_size))]
+            if not keys:
+                break
+            deleted += self.DBSession.execute(
+                table.delete(table.c.key.in_(keys))).rowcount
+            if len(keys) < self.sweep_batch_size:
+                break
+        return deleted
+
     def set_request_token_user(self, key, userid):
         r"""Register the user id for this token and also generate a verification
-        code."""
-        token = self.get_request_token(key)
-        if not token:
-            return
+        code (unless the token has one already).
+        This is a single conditional UPDATE. A token that is outdated or
+        already authorized by another user is not updated and None is returned
+        - the first authorization wins. Otherwise the updated token is returned.
+        On databases supporting UPDATE ... RETURNING the token comes back with
+        the UPDATE, elsewhere it is selected by its primary key afterwards.
+        """
+        table = self.RequestToken.__table__
+        condition = sa.and_(table.c.key == key,
+            sa.or_(table.c.userid == None, table.c.userid == userid))
+        if 'valid_till' in table.c:
+            condition = sa.and_(condition, sa.or_(table.c.valid_till == None,
+                table.c.valid_till > datetime.now()))
+        update = table.update(condition, dict(userid=userid,
+            verifier=sa.func.coalesce(table.c.verifier,
+                self.RequestToken.make_verifier())))
 
-        token.userid = userid
-        if not token.verifier:
-            token.generate_verifier()
-        self.DBSession.flush()
-        return token
+        session = self.DBSession
+        dialect = session.get_bind(self.RequestToken).dialect
+        if getattr(dialect, 'update_returning',
+                getattr(dialect, 'implicit_returning', False)):
+            row = session.execute(update.returning(*table.c)).first()
+            if row is None:
+                return
+            token = self.RequestToken(**dict((column.key, row[column])
+                for column in table.c))
+            _make_detached(token)
+            return session.merge(token, load=False)
+
+        if not session.execute(update).rowcount:
+            return
+        return session.query(self.RequestToken).populate_existing().filter_by(
+            key=key).first()
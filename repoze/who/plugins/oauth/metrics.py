@@ -0,0 +1,213 @@
+r"""In-process counters and latency histograms rendered in the Prometheus text
+exposition format."""
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+
+
+# The default latency histogram buckets (upper bounds in seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0)
+
+# The content type of the text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    r"""Escape a label value"""
+    return unicode(value).encode('utf-8').replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    r"""Format the label names and values as {name="value",...}"""
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    r"""Format a sample value"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    r"""The base of the metrics. The values are kept per tuple of label
+    values"""
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _check(self, labels):
+        r"""Check that a value is given for every label"""
+        labels = tuple(labels)
+        if len(labels) != len(self.labels):
+            raise ValueError('%s takes the labels %s' % (self.name,
+                ', '.join(self.labels)))
+        return labels
+
+    def samples(self):
+        r"""Return the (name suffix, label values, extra labels, value)
+        samples of the metric"""
+        raise NotImplementedError
+
+    def render(self):
+        r"""Render the metric in the text exposition format"""
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\\', r'\\')
+            .replace('\n', r'\n')), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                _format_labels(self.labels, values, extra),
+                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    r"""A monotonically increasing count"""
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        r"""Increase the count of the label values by amount"""
+        labels = self._check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        r"""Return the count of the label values"""
+        return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', labels, (), value) for labels, value in items]
+
+
+class Histogram(_Metric):
+    r"""Counts the observed values in fixed buckets and keeps their sum.
+
+    For initialization it takes (besides the name, help and labels):
+    - buckets - (optional) the sorted upper bounds of the buckets. Default -
+      DEFAULT_BUCKETS.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        r"""Count the value in the first bucket not smaller than it"""
+        labels = self._check(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # The bucket counts (the last one is +Inf), sum and count
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1),
+                    0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def value(self, labels=()):
+        r"""Return the (count, sum) of the values observed with the label
+        values"""
+        state = self._values.get(tuple(labels))
+        if state is None:
+            return 0, 0.0
+        return state[2], state[1]
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, (list(state[0]), state[1], state[2]))
+                for labels, state in self._values.items())
+        samples = []
+        bounds = self.buckets + (float('inf'),)
+        for labels, (counts, total, count) in items:
+            # The buckets are cumulative in the exposition format
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels,
+                    (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', labels, (), total))
+            samples.append(('_count', labels, (), count))
+        return samples
+
+
+class CallbackGauge(_Metric):
+    r"""A value read at the rendering time, e.g. from the cache statistics.
+
+    For initialization it takes (besides the name, help and labels):
+    - func - a function returning a dict of the values by the tuples of label
+      values (or a single value if there are no labels).
+    - type - (optional) the metric type to report. Default - 'gauge'.
+    """
+
+    def __init__(self, name, help, func, labels=(), type='gauge'):
+        _Metric.__init__(self, name, help, labels)
+        self.func = func
+        self.type = type
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', labels, (), value)
+            for labels, value in sorted(values.items())]
+
+
+class MetricsRegistry(object):
+    r"""A registry of the named metrics of a process. Asking for a metric
+    registered already returns the existing one so that several components may
+    share it.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        r"""Return the metric of the name, create it if needed"""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is registered as a %s' % (name,
+                    metric.type))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        r"""Return the counter of the name"""
+        return self._register(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        r"""Return the histogram of the name"""
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def callback(self, name, help, func, labels=(), type='gauge'):
+        r"""Return the metric of the name read from func at the rendering
+        time. A metric registered already keeps its function"""
+        return self._register(CallbackGauge, name, help, func, labels, type)
+
+    def get(self, name):
+        r"""Return the metric of the name or None"""
+        return self._metrics.get(name)
+
+    def render(self):
+        r"""Render all the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = self._metrics.values()
+        return ''.join(metric.render() for metric in metrics)
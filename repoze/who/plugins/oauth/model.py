@@ -1,19 +1,65 @@
 from cgi import parse_qs
 from datetime import datetime
-from random import choice
-from string import ascii_lowercase, ascii_letters, digits
+import os
+from string import ascii_lowercase, ascii_letters, digits, maketrans
+from threading import Lock
 from urllib import urlencode
 from urlparse import urlparse, urlunparse
 
 import sqlalchemy as sa
+from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 
 _Base = declarative_base()
 
 
+class RandomStringGenerator(object):
+    r"""A generator of cryptographically secure random strings over the given
+    alphabet (at most 256 characters long).
+    Random bytes are read from os.urandom in blocks of buffer_size and mapped
+    onto the alphabet in bulk. The mapped characters are buffered for the next
+    calls. The buffer is discarded in forked processes so that they never share
+    random strings with the parent.
+    """
+
+    def __init__(self, alphabet, buffer_size=1024):
+        self.alphabet = alphabet
+        self.buffer_size = buffer_size
+        size = len(alphabet)
+        # The bytes not less than the largest multiple of the alphabet size
+        # would make the first characters more probable. Reject them
+        limit = 256 - 256 % size
+        self._table = maketrans(''.join(map(chr, xrange(256))),
+            ''.join([alphabet[i % size] for i in xrange(limit)]).ljust(256))
+        self._rejected = ''.join(map(chr, xrange(limit, 256)))
+        self._buffer = ''
+        self._pid = None
+        self._lock = Lock()
+
+    def __call__(self, length):
+        r"""Generate a random string of the given length"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._buffer = ''
+                self._pid = os.getpid()
+            while len(self._buffer) < length:
+                self._buffer += os.urandom(self.buffer_size).translate(
+                    self._table, self._rejected)
+            result = self._buffer[:length]
+            self._buffer = self._buffer[length:]
+        return result
+
+
+_generators = {}
+
+
 def gen_random_string(length=40, alphabet=ascii_letters + digits):
     """Generate a random string of the given length and alphabet"""
-    return ''.join([choice(alphabet) for i in xrange(length)])
+    generator = _generators.get(alphabet)
+    if generator is None:
+        generator = _generators.setdefault(alphabet,
+            RandomStringGenerator(alphabet))
+    return generator(length)
 
 
 class Consumer(_Base):
@@ -26,14 +72,40 @@ class Consumer(_Base):
     created = sa.Column(sa.types.DateTime(), default=datetime.now)
 
 
+def _make_detached(instance):
+    r"""Turn a transient instance into a detached one as if it was loaded from
+    the database. Adding it to a session then makes it persistent without any
+    SQL. The attributes not set on the instance get loaded on access."""
+    make_transient_to_detached = getattr(orm, 'make_transient_to_detached',
+        None)
+    if make_transient_to_detached is not None:
+        # SQLAlchemy >= 0.9.5
+        make_transient_to_detached(instance)
+        return
+    state = orm.attributes.instance_state(instance)
+    mapper = orm.object_mapper(instance)
+    state.key = mapper.identity_key_from_instance(instance)
+    state.commit_all(state.dict)
+    state.expire_attributes(state.dict, [prop.key for prop in
+        mapper.iterate_properties if isinstance(prop, orm.ColumnProperty) and
+        prop.key not in state.dict])
+
+
 class Token(object):
     """A base class for tokens"""
 
+    # The number of keys to try when creating a token before giving up
+    max_key_attempts = 5
+
     @classmethod
-    def _create_token(cls, consumer_tokens, session=None, **kwargs):
-        """Create a token and append it to the provided consumer token list.  If
-        session given and a token with this key exists new random keys will be
-        tried until an unused key will be found
+    def _create_token(cls, consumer, tokens_attr, session=None, **kwargs):
+        """Create a token for the consumer.
+        If session given the token is inserted with a single INSERT statement
+        and attached to the session. If a token with this key exists new random
+        keys will be tried until an unused key will be found.
+        Otherwise (or if the consumer itself is not in the database yet) the
+        token is appended to the consumer token list named by tokens_attr and
+        saved on the next flush of the consumer session.
         """
         if not 'key' in kwargs:
             # Generate the key
@@ -41,23 +113,52 @@ class Token(object):
         if not 'secret' in kwargs:
             # Generate the secret
             kwargs['secret'] = gen_random_string(length=40)
-        # Create the token (in memory, not in DB yet)
+
+        consumer_state = orm.attributes.instance_state(consumer)
+        if session and consumer_state.key is None and consumer in session:
+            # The consumer is pending in the session. Save it first
+            session.flush()
+        if not session or consumer_state.key is None:
+            # Create the token (in memory, not in DB yet)
+            token = cls(**kwargs)
+            # Assign it to the consumer tokens list. It should be a dynamic
+            # relationship (as set up by the DefaultManager) - appending to it
+            # does not load the existing tokens.
+            getattr(consumer, tokens_attr).append(token)
+            return token
+
+        kwargs['consumer_key'] = consumer.key
+        attempt = 1
+        while True:
+            try:
+                return cls._insert_token(session, **kwargs)
+            except sa.exc.IntegrityError:
+                if attempt >= cls.max_key_attempts:
+                    raise
+                # A token with this key already exists. Generate a new key
+                kwargs['key'] = gen_random_string(length=40)
+                attempt += 1
+
+    @classmethod
+    def _insert_token(cls, session, **kwargs):
+        r"""Insert a token with the given column values using a single INSERT
+        statement and attach it to the session without querying it back"""
+        session.execute(cls.__table__.insert(), kwargs)
+        return cls._attach_token(session, **kwargs)
+
+    @classmethod
+    def _attach_token(cls, session, **kwargs):
+        r"""Construct the token inserted with the given column values and attach
+        it to the session as a persistent instance (without any SQL)"""
+        # The columns not given are NULL unless they have defaults. Let the
+        # columns with defaults load on access
+        for column in cls.__table__.columns:
+            if column.key not in kwargs and column.default is None and \
+                    column.server_default is None:
+                kwargs[column.key] = None
         token = cls(**kwargs)
-        # Assign it to the consumer tokens list
-        consumer_tokens.append(token)
-        # If the session is provided then on flush we can get an integrity error
-        # in case such a key already exists. In that case re-generate the key
-        # and try again.
-        if session:
-            while True:
-                try:
-                    session.flush()
-                except (sa.exc.IntegrityError, sa.exc.FlushError):
-                    # A token with this key already exists. Generate a new key
-                    token.key = gen_random_string(length=40)
-                else:
-                    # The token key is unique
-                    break
+        _make_detached(token)
+        session.add(token)
         return token
 
 
@@ -72,28 +173,33 @@ class RequestToken(_Base, Token):
     # A url to redirect the user to after token verification. If no URL
     # available then must be 'oob'
     callback = sa.Column(sa.types.Unicode(500))
-    created = sa.Column(sa.types.DateTime(), default=datetime.now)
+    # Indexed for the sweeper to find stale unauthorized tokens
+    created = sa.Column(sa.types.DateTime(), default=datetime.now, index=True)
     # The plugin does not set valid_till as it can vary or may not be used at
     # all. The server app is responsible to set the value. The manager will
     # check this value when looking for request tokens if valid_till is not NULL
-    valid_till = sa.Column(sa.types.DateTime())
+    valid_till = sa.Column(sa.types.DateTime(), index=True)
 
     @classmethod
     def create(cls, consumer, callback, session=None, **kwargs):
         r"""Create a request token instance and assign it to a consumer"""
         # Ensure the callback is in unicode
         callback = unicode(callback)
-        return cls._create_token(consumer.request_tokens, session=session,
+        return cls._create_token(consumer, 'request_tokens', session=session,
             callback=callback, **kwargs)
 
-    def generate_verifier(self):
+    @staticmethod
+    def make_verifier():
         r"""Use the gen_random_string to generate a 6 char string from lowercase
         letters and digits. We are using lowercase letters only because the
         client and/or server applications may decide to treat the verification
         code as being case insensitive (for user convenience)
         """
-        self.verifier = gen_random_string(length=6,
-            alphabet=ascii_lowercase + digits)
+        return gen_random_string(length=6, alphabet=ascii_lowercase + digits)
+
+    def generate_verifier(self):
+        r"""Generate a verification code for this token (see make_verifier)"""
+        self.verifier = self.make_verifier()
 
     @property
     def callback_url(self):
@@ -124,14 +230,14 @@ class AccessToken(_Base, Token):
     # The plugin does not set valid_till as it can vary or may not be used at
     # all. The server app is responsible to set the value. The manager will
     # check this value when looking for request tokens if valid_till is not NULL
-    valid_till = sa.Column(sa.types.DateTime())
+    valid_till = sa.Column(sa.types.DateTime(), index=True)
 
     @classmethod
     def create(cls, consumer, userid, session=None, **kwargs):
         r"""Create an access token instance and assign it to the consumer and
         user
         """
-        return cls._create_token(consumer.access_tokens, userid=userid,
+        return cls._create_token(consumer, 'access_tokens', userid=userid,
             session=session, **kwargs)
 
 
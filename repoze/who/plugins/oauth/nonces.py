@@ -0,0 +1,446 @@
+r"""Nonce stores remembering the (timestamp, nonce) pairs of the verified
+requests to reject the replayed ones."""
+from hashlib import md5
+import logging
+import math
+import struct
+from threading import Event, Lock
+import time
+
+import sqlalchemy as sa
+
+from .request import _utf8
+
+log = logging.getLogger(__name__)
+
+
+class NonceStore(object):
+    r"""The nonce store interface.
+
+    A nonce may be used once per consumer, token and timestamp. The stores only
+    need to remember the nonces within the timestamp window - the requests
+    with older timestamps are rejected anyway.
+    """
+
+    def add(self, consumer_key, token_key, timestamp, nonce):
+        r"""Remember the nonce. Return True if it was not used before for the
+        consumer, token (None for 2-legged requests) and timestamp (an int), or
+        False if it was (or the timestamp is outside of the window the store
+        remembers)"""
+        raise NotImplementedError
+
+
+class MemoryNonceStore(NonceStore):
+    r"""An in-process nonce store. The nonces are kept in buckets by timestamp
+    so that both lookups and inserts are single set operations and the whole
+    buckets are dropped as their timestamps leave the window.
+
+    For initialization it takes:
+    - window - (optional) the number of seconds the nonces are remembered.
+      Timestamps further in the past or in the future are rejected. Default
+      - 300.
+    - bucket_size - (optional) the number of seconds of timestamps per bucket.
+      Default - 10.
+    - max_nonces - (optional) the maximum number of nonces to keep. When full,
+      the oldest bucket is dropped and the timestamps up to its end are
+      rejected from then on - the window shrinks instead of letting the
+      replays in. Default - 1000000.
+    - timer - (optional) a function returning the current time in seconds.
+      Default - time.time.
+    """
+
+    def __init__(self, window=300, bucket_size=10, max_nonces=1000000,
+            timer=time.time):
+        self.window = int(window)
+        self.bucket_size = int(bucket_size)
+        self.max_nonces = int(max_nonces)
+        self.timer = timer
+        # Sets of (consumer key, token key, timestamp, nonce) by bucket index
+        self._buckets = {}
+        # The index of the oldest bucket accepted
+        self._oldest = None
+        # The buckets dropped to stay within max_nonces push the oldest bucket
+        # accepted forward
+        self._floor = None
+        self._size = 0
+        self._lock = Lock()
+
+    def _expire(self, now):
+        r"""Drop the buckets older than the window"""
+        oldest = (now - self.window) // self.bucket_size
+        if self._floor is not None and self._floor > oldest:
+            oldest = self._floor
+        if oldest == self._oldest:
+            return
+        self._oldest = oldest
+        for index in [index for index in self._buckets if index < oldest]:
+            self._size -= len(self._buckets.pop(index))
+
+    def add(self, consumer_key, token_key, timestamp, nonce):
+        now = int(self.timer())
+        if not now - self.window <= timestamp <= now + self.window:
+            return False
+        index = timestamp // self.bucket_size
+        entry = (consumer_key, token_key, timestamp, nonce)
+        with self._lock:
+            self._expire(now)
+            if index < self._oldest:
+                return False
+            bucket = self._buckets.get(index)
+            if bucket is None:
+                bucket = self._buckets[index] = set()
+            elif entry in bucket:
+                # Replayed
+                return False
+            bucket.add(entry)
+            self._size += 1
+            while self._size > self.max_nonces and len(self._buckets) > 1:
+                # Full. Give up the oldest bucket and the timestamps in it
+                first = min(self._buckets)
+                self._size -= len(self._buckets.pop(first))
+                self._floor = first + 1
+                self._expire(now)
+            return True
+
+    def counts(self):
+        r"""Return the number of nonces by the first timestamp of their
+        bucket"""
+        with self._lock:
+            return dict((index * self.bucket_size, len(bucket))
+                for index, bucket in self._buckets.iteritems())
+
+    def __len__(self):
+        return self._size
+
+
+class BloomNonceStore(NonceStore):
+    r"""An in-process nonce store of fixed size. The nonces are remembered in a
+    pair of Bloom filters - the current one takes the new nonces, both are
+    looked up. The filters are rotated every 2 * window seconds (the previous
+    one is dropped) so that a nonce is remembered at least as long as its
+    timestamp (which may be up to window seconds ahead) is accepted.
+    A nonce never used before is rejected with the probability of a false
+    positive, which stays under error_rate as long as no more than rate nonces
+    per second are added on average - each filter is sized for half of it as
+    both are looked up.
+
+    For initialization it takes:
+    - window - (optional) the number of seconds the nonces are remembered.
+      Timestamps further in the past or in the future are rejected. Default
+      - 300.
+    - rate - (optional) the expected number of nonces per second. Default -
+      1000.
+    - error_rate - (optional) the target false positive rate. Default - 0.001.
+    - timer - (optional) a function returning the current time in seconds.
+      Default - time.time.
+    """
+
+    def __init__(self, window=300, rate=1000, error_rate=0.001,
+            timer=time.time):
+        self.window = int(window)
+        self.period = 2 * self.window
+        self.error_rate = float(error_rate)
+        self.timer = timer
+        # The number of nonces a filter is expected to take
+        self.capacity = max(1, int(float(rate) * self.period))
+        # The optimal number of bits and hash functions for the capacity and
+        # half the error rate - a false positive of either filter counts
+        self.bits = int(math.ceil(-self.capacity *
+            math.log(self.error_rate / 2) / math.log(2) ** 2))
+        self.bits += -self.bits % 8
+        self.hashes = max(1, int(round(self.bits / float(self.capacity) *
+            math.log(2))))
+        # The memory taken by the filters in bytes
+        self.memory_size = 2 * self.bits // 8
+        self._current = bytearray(self.bits // 8)
+        self._previous = bytearray(self.bits // 8)
+        # The number of bits set in the filters
+        self._current_set = 0
+        self._previous_set = 0
+        self._rotated = int(self.timer())
+        self._lock = Lock()
+
+    def _positions(self, key):
+        r"""The bit positions of the key (double hashing)"""
+        h1, h2 = struct.unpack('<QQ', md5(key).digest())
+        h2 |= 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in xrange(self.hashes)]
+
+    def _rotate(self, now):
+        r"""Start a new current filter if the period is over"""
+        periods = (now - self._rotated) // self.period
+        if periods <= 0:
+            return
+        if periods == 1:
+            self._previous, self._previous_set = \
+                self._current, self._current_set
+        else:
+            # Both filters are outdated
+            self._previous, self._previous_set = bytearray(self.bits // 8), 0
+        self._current, self._current_set = bytearray(self.bits // 8), 0
+        self._rotated += periods * self.period
+
+    def add(self, consumer_key, token_key, timestamp, nonce):
+        now = int(self.timer())
+        if not now - self.window <= timestamp <= now + self.window:
+            return False
+        positions = self._positions('%s\0%s\0%d\0%s' % (_utf8(consumer_key),
+            _utf8(token_key or ''), timestamp, _utf8(nonce)))
+        with self._lock:
+            self._rotate(now)
+            current, previous = self._current, self._previous
+            if all(current[p >> 3] & (1 << (p & 7)) for p in positions) or \
+                    all(previous[p >> 3] & (1 << (p & 7)) for p in positions):
+                # (Probably) replayed
+                return False
+            for p in positions:
+                mask = 1 << (p & 7)
+                if not current[p >> 3] & mask:
+                    current[p >> 3] |= mask
+                    self._current_set += 1
+            return True
+
+    def fill_ratio(self):
+        r"""Return the share of the bits set in the current filter"""
+        return self._current_set / float(self.bits)
+
+    def false_positive_rate(self):
+        r"""Return the estimated probability that a new nonce is taken for a
+        replayed one"""
+        current = self.fill_ratio() ** self.hashes
+        previous = (self._previous_set / float(self.bits)) ** self.hashes
+        return 1 - (1 - current) * (1 - previous)
+
+
+def _unicode(s):
+    r"""Decode utf-8 encoded strings, leave unicode strings as they are"""
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+class _Batch(object):
+    r"""The nonces to write together and the results of the write"""
+
+    def __init__(self):
+        self.entries = []
+        self.results = None
+        self.done = Event()
+
+
+class SQLNonceStore(NonceStore):
+    r"""A nonce store in the database, shared by all the processes using it.
+
+    The nonces are kept in a ring of tables with a unique constraint on
+    (nonce, consumer_key, token_key, timestamp) - nonce first so that the
+    lookups by nonce use its index. Each table takes the
+    timestamps of a partition_size seconds long slice. As the time goes on the
+    table of the slice to come next is emptied with a single statement
+    (TRUNCATE if supported) instead of deleting the outdated nonces one by one.
+    There are enough tables for all the slices within the window on both sides
+    plus a spare one for the clocks of the processes being a bit off.
+
+    The concurrent calls are written together: if other calls are in
+    progress, the first call waits batch_window seconds for the others to join
+    and writes them all in a single transaction. A call on its own is written
+    right away. The nonces are rejected if the write fails.
+
+    For initialization it takes:
+    - engine - an SQLAlchemy database engine or an engine url. The plugin passes
+      the engine of its manager by default.
+    - window - (optional) the number of seconds the nonces are remembered.
+      Timestamps further in the past or in the future are rejected. Default
+      - 300.
+    - partition_size - (optional) the number of seconds of timestamps per
+      table. Default - 60.
+    - batch_window - (optional) the number of seconds to wait for the other
+      nonces to write together. Default - 0.005.
+    - batch_size - (optional) the maximum number of nonces written together.
+      Default - 500.
+    - table_prefix - (optional) the prefix of the table names, followed by the
+      table number. Default - 'oauth_nonces_'.
+    - timer - (optional) a function returning the current time in seconds.
+      Default - time.time.
+    """
+
+    # Ask the plugin for the manager engine
+    needs_engine = True
+    # The longest nonce accepted
+    max_nonce_length = 100
+    # The number of write attempts if the same nonces are written concurrently
+    max_write_attempts = 3
+
+    def __init__(self, engine, window=300, partition_size=60,
+            batch_window=0.005, batch_size=500, table_prefix='oauth_nonces_',
+            timer=time.time):
+        if not isinstance(engine, sa.engine.base.Engine):
+            engine = sa.create_engine(engine)
+        self.engine = engine
+        self.window = int(window)
+        self.partition_size = int(partition_size)
+        self.batch_window = float(batch_window)
+        self.batch_size = int(batch_size)
+        self.timer = timer
+        # The slices the accepted timestamps may fall in, the one to be
+        # emptied next and the spare one
+        self.partitions = -(-2 * self.window // self.partition_size) + 3
+        self.metadata = sa.MetaData(bind=engine)
+        self.tables = [self._make_table('%s%d' % (table_prefix, i))
+            for i in xrange(self.partitions)]
+        self.metadata.create_all(checkfirst=True)
+        # The last slice the tables were prepared for
+        self._slice = None
+        self._batch = None
+        # The number of the calls in progress
+        self._active = 0
+        self._lock = Lock()
+
+    def _make_table(self, name):
+        r"""Define a nonce table"""
+        return sa.Table(name, self.metadata,
+            sa.Column('consumer_key', sa.types.String(40), nullable=False),
+            # Not NULL - NULLs are never equal in the unique constraints
+            sa.Column('token_key', sa.types.String(40), nullable=False),
+            sa.Column('nonce', sa.types.String(self.max_nonce_length),
+                nullable=False),
+            sa.Column('timestamp', sa.types.Integer(), nullable=False),
+            # The nonce leads so that the batch lookups by nonce are index
+            # scans
+            sa.UniqueConstraint('nonce', 'consumer_key', 'token_key',
+                'timestamp', name='uq_%s' % name))
+
+    def _table(self, timestamp):
+        r"""Return the table taking the timestamp"""
+        return self.tables[timestamp // self.partition_size % self.partitions]
+
+    def _empty(self, table):
+        r"""Remove all the nonces of the table in one go"""
+        dialect = self.engine.dialect
+        if dialect.name in ('postgresql', 'mysql'):
+            statement = sa.text('TRUNCATE TABLE %s' %
+                dialect.identifier_preparer.format_table(table))
+        else:
+            # SQLite optimizes unconditional deletes to truncates
+            statement = table.delete()
+        # In a transaction of its own - TRUNCATE is not autocommitted
+        conn = self.engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                conn.execute(statement)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+
+    def _prepare(self, now):
+        r"""Empty the tables of the slices past the window ahead (and behind,
+        but the spare one) once the slice changes. The tables of the slices
+        within the window are never emptied - other processes write into them.
+        The outdated nonces left in such tables (if no call came in while they
+        were up next) are harmless as the timestamps are compared too. They
+        are removed when the table comes up next time"""
+        current = now // self.partition_size
+        if self._slice is not None and current <= self._slice:
+            return
+        self._slice = current
+        # The slice after the last one the timestamps may fall in, up to the
+        # one before the spare one behind the window
+        first = (now + self.window) // self.partition_size + 1
+        last = (now - self.window) // self.partition_size - 2 + \
+            self.partitions
+        for index in xrange(first, last + 1):
+            self._empty(self.tables[index % self.partitions])
+
+    def add(self, consumer_key, token_key, timestamp, nonce):
+        now = int(self.timer())
+        if not now - self.window <= timestamp <= now + self.window or \
+                len(nonce) > self.max_nonce_length:
+            return False
+        with self._lock:
+            self._active += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+                # Wait for the others only if there are any about
+                wait = self._active > 1
+            index = len(batch.entries)
+            # Unicode - as the strings are read back from the database
+            batch.entries.append((_unicode(consumer_key),
+                _unicode(token_key or ''), _unicode(nonce), timestamp))
+            if len(batch.entries) >= self.batch_size:
+                # Full - the next calls start a new batch
+                self._batch = None
+        try:
+            if leader:
+                if wait:
+                    # Let the others join
+                    time.sleep(self.batch_window)
+                with self._lock:
+                    if self._batch is batch:
+                        self._batch = None
+                try:
+                    self._prepare(now)
+                    batch.results = self._write(batch.entries)
+                except Exception:
+                    log.exception('Writing the nonces failed')
+                batch.done.set()
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._active -= 1
+        return bool(batch.results and batch.results[index])
+
+    def _write(self, entries):
+        r"""Write the (consumer_key, token_key, nonce, timestamp) entries in a
+        single transaction. Return a list of flags whether they were new"""
+        for attempt in xrange(self.max_write_attempts):
+            try:
+                return self._try_write(entries)
+            except sa.exc.IntegrityError:
+                # Some of the nonces were written by another process meanwhile.
+                # They will be found this time
+                if attempt + 1 >= self.max_write_attempts:
+                    raise
+
+    def _try_write(self, entries):
+        r"""Look up the entries and insert the new ones"""
+        results = []
+        # The new entries by table
+        new = {}
+        seen = set()
+        for entry in entries:
+            # The same nonce may be repeated in the batch
+            results.append(entry not in seen)
+            seen.add(entry)
+            if results[-1]:
+                new.setdefault(self._table(entry[3]), []).append(entry)
+        conn = self.engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                existing = set()
+                for table, table_entries in new.iteritems():
+                    existing.update(tuple(row) for row in conn.execute(
+                        sa.select([table.c.consumer_key, table.c.token_key,
+                            table.c.nonce, table.c.timestamp],
+                        table.c.nonce.in_(set(entry[2]
+                            for entry in table_entries)))))
+                    rows = [dict(consumer_key=entry[0], token_key=entry[1],
+                        nonce=entry[2], timestamp=entry[3])
+                        for entry in table_entries if entry not in existing]
+                    if rows:
+                        conn.execute(table.insert(), rows)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+        return [result and entry not in existing
+            for result, entry in zip(results, entries)]
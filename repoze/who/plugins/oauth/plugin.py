@@ -1,18 +1,67 @@
-import cgi
+from bisect import bisect_right
+from cStringIO import StringIO
+import re
+import time
 from urllib import urlencode
+from urlparse import parse_qsl
 
 import oauth2
 from paste.httpexceptions import HTTPUnauthorized
 from paste.httpheaders import AUTHORIZATION, WWW_AUTHENTICATE
-from paste.request import parse_formvars, parse_querystring, construct_url
+from paste.util.converters import asbool
 from zope.interface import implements
-from webob import Request
 
 from repoze.who.config import _resolve
 from repoze.who.interfaces import IIdentifier, IAuthenticator, IChallenger
 
+from .executor import VerificationExecutor
 from .managers import DefaultManager
-from .signatures import SignatureMethod_RSA_SHA1
+from .metrics import CONTENT_TYPE, MetricsRegistry
+from .nonces import MemoryNonceStore
+from .request import Request
+from .signatures import SignatureMethod_HMAC_SHA1, SignatureMethod_RSA_SHA1
+from .timing import Timings, TimedManager
+from .verifier import Verifier
+
+
+# The environ keys the plugin stores its work under for the later layers
+# (authenticate, repoze.what predicates, the application) to reuse:
+# - the dict of the OAuth parameters extracted by identify
+PARAMS_KEY = 'repoze.who.plugins.oauth.params'
+# - the oauth2.Request (request.Request) constructed to verify the request
+#   signature
+REQUEST_KEY = 'repoze.who.plugins.oauth.request'
+# - the list of (stage, seconds) pairs timed if the timing is enabled
+TIMINGS_KEY = 'repoze.who.plugins.oauth.timings'
+# Set once the request is counted as a non-oauth one
+_COUNTED_KEY = 'repoze.who.plugins.oauth.counted'
+
+
+# Matches the OAuth scheme of the Authorization header
+_oauth_scheme = re.compile(r'\s*oauth\s', re.I).match
+
+
+def _has_oauth_marker(environ):
+    r"""A cheap check whether the request may carry OAuth parameters at all:
+    an OAuth Authorization header, oauth_ in the query string or a form encoded
+    body. Nothing gets parsed (or allocated) for the requests without them.
+    """
+    auth_header = environ.get('HTTP_AUTHORIZATION')
+    if auth_header and _oauth_scheme(auth_header):
+        return True
+    if 'oauth_' in environ.get('QUERY_STRING', ''):
+        return True
+    content_type = environ.get('CONTENT_TYPE')
+    if content_type and content_type[:33].lower() == \
+            'application/x-www-form-urlencoded':
+        return environ.get('CONTENT_LENGTH') not in (None, '', '0', 0)
+    return False
+
+
+def _oauth_pairs(pairs):
+    r"""Filter out the non-oauth parameters from the (key, value) pairs"""
+    return [(key, value) for key, value in pairs
+        if key.startswith('oauth_') or key == 'realm']
 
 
 class OAuthPlugin(object):
@@ -30,6 +79,36 @@ class OAuthPlugin(object):
       - '/oauth/request_token'
     - access_token_path - (optional) a path to serve access tokens. Default -
       '/oauth/access_token'
+    - max_body_size - (optional) the largest form encoded request body (in
+      bytes) to look for the OAuth parameters in. Default - 1048576.
+    - protected_paths - (optional) a list (or a whitespace separated string) of
+      path prefixes, e.g. '/api/'. OAuth requests are processed only under
+      these prefixes (and on the token paths). Default - None, all paths.
+    - native_verifier - (optional) verify the requests with the Verifier of
+      this package instead of oauth2.Server. Default - False.
+    - hmac_key_cache_size - (optional) the number of HMAC keys (per consumer
+      and token secret pair) the native verifier keeps. Default - 1000.
+    - rsa_key_cache_size - (optional) the number of imported consumer RSA keys
+      to keep. Default - 1000.
+    - rsa_workers - (optional) the number of workers to run the RSA-SHA1
+      signature checks in. 0 runs them in the request thread. Default - 0.
+    - rsa_worker_type - (optional) 'process' or 'thread'. Default - 'process'.
+    - rsa_timeout - (optional) the number of seconds to wait for an RSA-SHA1
+      signature check in a worker. The request fails if exceeded. Default - 5.
+    - nonce_store - (optional) a NonceStore instance or class (may be given as
+      an entry point) to reject the replayed requests with. The classes are
+      instantiated with the window of the timestamp check and the nonce_*
+      options (without the prefix). None or an empty string disables the
+      replay protection. Default - repoze.who.plugins.oauth.MemoryNonceStore.
+    - timing - (optional) record the wall time of the parameter parsing, each
+      validator and each manager call in environ[TIMINGS_KEY]. Default - False.
+    - timing_sink - (optional) a callable (or an entry point of one) taking
+      the environ, stage name and seconds of every stage timed. Default - None.
+    - metrics - (optional) keep the request outcome counters, latency
+      histograms and the manager statistics in a MetricsRegistry (True creates
+      one). Default - False.
+    - metrics_path - (optional) a path to serve the metrics on in the
+      Prometheus text format. Enables the metrics. Default - None.
     """
     
     # This plugin is an identifier, authenticator and challenger
@@ -40,60 +119,220 @@ class OAuthPlugin(object):
             realm='',
             request_token_path='/oauth/request_token',
             access_token_path='/oauth/access_token',
+            max_body_size=1048576,
+            protected_paths=None,
+            native_verifier=False,
+            hmac_key_cache_size=1000,
+            rsa_key_cache_size=1000,
+            rsa_workers=0,
+            rsa_worker_type='process',
+            rsa_timeout=5,
+            nonce_store=MemoryNonceStore,
+            timing=False,
+            timing_sink=None,
+            metrics=False,
+            metrics_path=None,
             **kwargs
         ):
 
         self.realm = realm
-        # The oauth2 server implementation to handle signatures
-        self.server = oauth2.Server(signature_methods={
-            # Supported signature methods
-            'HMAC-SHA1': oauth2.SignatureMethod_HMAC_SHA1(),
-            'RSA-SHA1': SignatureMethod_RSA_SHA1(),
-        })
+        self.max_body_size = int(max_body_size)
+        # The RSA signature checks may be offloaded to a worker pool
+        self.rsa_executor = None
+        if int(rsa_workers):
+            if rsa_worker_type not in ('process', 'thread'):
+                raise ValueError('Unknown rsa_worker_type %s' % rsa_worker_type)
+            self.rsa_executor = VerificationExecutor(workers=int(rsa_workers),
+                timeout=float(rsa_timeout),
+                processes=rsa_worker_type == 'process')
+        # The RSA keys are imported once
+        rsa_sha1 = SignatureMethod_RSA_SHA1(
+            key_cache_size=int(rsa_key_cache_size),
+            executor=self.rsa_executor)
+        if asbool(native_verifier):
+            # The lean verifier with the native signature methods
+            self.server = Verifier(signature_methods={
+                'HMAC-SHA1': SignatureMethod_HMAC_SHA1(
+                    key_cache_size=int(hmac_key_cache_size)),
+                'RSA-SHA1': rsa_sha1,
+            })
+        else:
+            # The oauth2 server implementation to handle signatures
+            self.server = oauth2.Server(signature_methods={
+                # Supported signature methods
+                'HMAC-SHA1': oauth2.SignatureMethod_HMAC_SHA1(),
+                'RSA-SHA1': rsa_sha1,
+            })
 
         # Remember the paths to serve the tokens on
         self.paths = dict(
             request=request_token_path,
-            access=access_token_path)
+            access=access_token_path,
+            metrics=metrics_path or None)
+
+        # The path prefixes to process the OAuth requests under
+        if isinstance(protected_paths, basestring):
+            protected_paths = protected_paths.split()
+        if protected_paths is None:
+            self.protected_paths = None
+        else:
+            # Keep the prefixes sorted and drop the ones covered by shorter
+            # prefixes. Then the only prefix a path can start with is the
+            # closest one not greater than the path
+            self.protected_paths = []
+            for prefix in sorted(set(protected_paths)):
+                if not (self.protected_paths and
+                        prefix.startswith(self.protected_paths[-1])):
+                    self.protected_paths.append(prefix)
+
+        # The nonce store options are given with the nonce_ prefix
+        nonce_options = dict((key[6:], kwargs.pop(key))
+            for key in kwargs.keys() if key.startswith('nonce_'))
 
         # Allow manager to be provided as an entry point from config
         if isinstance(manager, (str, unicode)):
             manager = _resolve(manager)
         self.manager = manager(**kwargs)
 
+        # Allow the nonce store to be provided as an entry point from config
+        if isinstance(nonce_store, (str, unicode)):
+            nonce_store = _resolve(nonce_store) if nonce_store.strip() else None
+        if isinstance(nonce_store, type):
+            # Remember the nonces as long as the timestamps are accepted
+            nonce_options.setdefault('window',
+                self.server.timestamp_threshold)
+            if getattr(nonce_store, 'needs_engine', False):
+                # Share the database with the manager
+                nonce_options.setdefault('engine', self.manager.metadata.bind)
+            nonce_store = nonce_store(**nonce_options)
+        self.nonce_store = nonce_store
+
+        # Allow the timing sink to be provided as an entry point from config
+        if isinstance(timing_sink, (str, unicode)):
+            timing_sink = _resolve(timing_sink) if timing_sink.strip() else None
+        self.timing = asbool(timing)
+        self.timing_sink = timing_sink
+
+        # The in-process metrics
+        if not isinstance(metrics, MetricsRegistry):
+            metrics = MetricsRegistry() if asbool(metrics) or \
+                self.paths['metrics'] else None
+        self.metrics = metrics
+        if metrics is not None:
+            self._requests = metrics.counter('oauth_requests_total',
+                'Authentication outcomes by request type.',
+                labels=('type', 'outcome'))
+            self._request_time = metrics.histogram(
+                'oauth_authenticate_seconds',
+                'Authentication time in seconds by request type.',
+                labels=('type',))
+            self._validator_failures = metrics.counter(
+                'oauth_validator_failures_total',
+                'Failed validators.', labels=('validator',))
+            # The cache statistics and query times of the manager
+            if hasattr(self.manager, 'register_metrics'):
+                self.manager.register_metrics(metrics)
+
+    def _timings(self, environ):
+        r"""Return the Timings recording in environ[TIMINGS_KEY]"""
+        return Timings(environ.setdefault(TIMINGS_KEY, []),
+            sink=self.timing_sink, environ=environ)
 
     def _parse_params(self, environ):
-        # Try to find the parameters in various sources,
-        # reflecting preference order:
+        r"""Extract the oauth parameters (and realm) in a single pass over the
+        sources, reflecting preference order: query string, form encoded POST
+        body (if not larger than max_body_size), Authorization header.
+        """
+        params = {}
         # Query string
-        params = dict(parse_querystring(environ))
+        query = environ.get('QUERY_STRING')
+        if query:
+            params.update(_oauth_pairs(parse_qsl(query, True)))
         # POST body
-        request = Request(environ)
-        if request.content_type == 'application/x-www-form-urlencoded':
-            body = request.body
-            params.update(parse_formvars(environ, include_get_vars=False))
-            request.body = body
+        content_type = environ.get('CONTENT_TYPE', '')
+        if content_type.split(';', 1)[0].strip().lower() == \
+                'application/x-www-form-urlencoded':
+            body = self._read_body(environ)
+            if body:
+                params.update(_oauth_pairs(parse_qsl(body, True)))
         # Authorization header
         auth_header = AUTHORIZATION(environ)
         if auth_header:
             try:
-                params.update(oauth2.Request._split_header(auth_header))
+                params.update(_oauth_pairs(
+                    oauth2.Request._split_header(auth_header).iteritems()))
             except:
                 pass
-        # Remove the non-oauth params
-        if params:
-            for key in params.keys():
-                if not (key.startswith('oauth_') or key == 'realm'):
-                    del params[key]
 
-        return dict(params)
+        return params
+
+    def _read_body(self, environ):
+        r"""Read the request body if it is not larger than max_body_size and
+        leave wsgi.input as it was for the downstream app. Seekable inputs are
+        rewound, the others are replaced with a buffer of the body read.
+        """
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return
+        if length <= 0 or length > self.max_body_size:
+            return
+        wsgi_input = environ['wsgi.input']
+        try:
+            position = wsgi_input.tell()
+        except (AttributeError, IOError):
+            position = None
+        body = wsgi_input.read(length)
+        if position is not None:
+            try:
+                wsgi_input.seek(position)
+                return body
+            except (AttributeError, IOError):
+                pass
+        environ['wsgi.input'] = StringIO(body)
+        return body
+
+    def _is_protected(self, path):
+        r"""Check whether the OAuth requests are to be processed on the path"""
+        prefixes = self.protected_paths
+        if prefixes is None or path in (self.paths['request'],
+                self.paths['access']):
+            return True
+        i = bisect_right(prefixes, path)
+        return i > 0 and path.startswith(prefixes[i - 1])
 
     # IIdentifier
     def identify(self, environ):
-        r"""Extract the oauth parameters if present"""
-        oauth_params = self._parse_params(environ)
+        r"""Extract the oauth parameters if present. The parameters are parsed
+        once per request and kept in environ[PARAMS_KEY]"""
+        if self.paths['metrics'] and \
+                environ.get('PATH_INFO') == self.paths['metrics']:
+            # Serve the metrics instead of the downstream app
+            environ['repoze.who.application'] = self._metrics_app
+            return None
+        oauth_params = environ.get(PARAMS_KEY)
+        if oauth_params is None:
+            if not self._is_protected(environ.get('PATH_INFO', '')):
+                # Not our business
+                oauth_params = {}
+            elif not _has_oauth_marker(environ):
+                # Not an OAuth request - the fast path
+                oauth_params = {}
+            else:
+                if self.timing:
+                    oauth_params = self._timings(environ).call('parse',
+                        self._parse_params, environ)
+                else:
+                    oauth_params = self._parse_params(environ)
+                environ[PARAMS_KEY] = oauth_params
         if oauth_params:
-            return oauth_params
+            # repoze.who adds its own keys to the identity - give it a copy
+            return dict(oauth_params)
+        if self.metrics is not None and not environ.get(_COUNTED_KEY):
+            # authenticate is not called for the requests no identifier
+            # recognizes - count them here
+            environ[_COUNTED_KEY] = True
+            self._requests.inc(('non-oauth', 'ignored'))
         return None
 
 
@@ -120,6 +359,15 @@ class OAuthPlugin(object):
             return '2-legged'
         return 'non-oauth'
 
+    def _metrics_app(self, environ, start_response):
+        r"""Render the metrics in the Prometheus text format"""
+        body = self.metrics.render()
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
     def _check_POST(self, env):
         r"""Token requests have to be POSTed. Check this"""
         return env['environ']['REQUEST_METHOD'].upper() == 'POST'
@@ -149,7 +397,8 @@ class OAuthPlugin(object):
         r"""Try to find a consumer according to the oauth_consumer_key
         parameter. Die if unsuccessful.
         """
-        consumer = self.manager.get_consumer_by_key(
+        manager = env.get('manager', self.manager)
+        consumer = manager.get_consumer_by_key(
             env['identity'].get('oauth_consumer_key'))
         if consumer:
             # Consumer found - remember it
@@ -163,7 +412,8 @@ class OAuthPlugin(object):
         """
         token_key = env['identity'].get('oauth_token')
         verifier = env['identity'].get('oauth_verifier')
-        token = self.manager.get_request_token(token_key)
+        manager = env.get('manager', self.manager)
+        token = manager.get_request_token(token_key)
         if token and verifier and token.verifier == verifier:
             # A matching token found - remember it
             env['token'] = token
@@ -175,34 +425,71 @@ class OAuthPlugin(object):
         Die if unsuccessful.
         """
         token_key = env['identity'].get('oauth_token')
-        token = self.manager.get_access_token(token_key, env['consumer'])
+        manager = env.get('manager', self.manager)
+        token = manager.get_access_token(token_key, env['consumer'])
         if token:
             # A matching token found - remember it
             env['token'] = token
             return True
         return False
     
+    def _get_consumer_and_access_token(self, env):
+        r"""Try to find a consumer and an access token according to the
+        oauth_consumer_key and oauth_token parameters in one go if the manager
+        supports it. Die if unsuccessful.
+        """
+        getter = getattr(env.get('manager', self.manager),
+            'get_consumer_and_access_token', None)
+        if getter is None:
+            # Fall back to the separate lookups
+            return self._get_consumer(env) and self._get_access_token(env)
+
+        consumer, token = getter(env['identity'].get('oauth_consumer_key'),
+            env['identity'].get('oauth_token'))
+        if not consumer:
+            return False
+        # Consumer found - remember it
+        env['consumer'] = consumer
+        if token:
+            # A matching token found - remember it
+            env['token'] = token
+            return True
+        return False
+
     def _verify_request(self, env):
         r"""Construct an oauth2 request from the parameters and verify the
         signature. Die if unsuccessful.
+        The request is kept in environ[REQUEST_KEY] for later use.
         """
-        req = oauth2.Request(
-            method=env['environ']['REQUEST_METHOD'],
-            # A full url is needed
-            url=construct_url(env['environ'], with_query_string=False),
-            parameters=env['identity'])
-        try:
-            self.server.verify_request(req, env['consumer'], env.get('token'))
-        except oauth2.Error, e:
-            # Verification error
-            return False
-        return True
+        # The native request builds the signature base string itself
+        req = env['environ'][REQUEST_KEY] = Request.from_environ(
+            env['environ'], env['identity'])
+        token = env.get('token')
+        if isinstance(self.server, Verifier):
+            # No exceptions on the failure paths
+            if not self.server.check_request(req, env['consumer'], token):
+                return False
+        else:
+            try:
+                self.server.verify_request(req, env['consumer'], token)
+            except oauth2.Error, e:
+                # Verification error
+                return False
+        if self.nonce_store is None:
+            return True
+        # The request is genuine. Make sure it is not a replay. Only the signed
+        # requests get this far so the store can not be flooded with forged
+        # nonces
+        return self.nonce_store.add(env['consumer'].key,
+            token.key if token else None, int(req['oauth_timestamp']),
+            req['oauth_nonce'])
 
     def _request_token_app(self, env):
         r"""Create a request token application."""
         def token_app(environ, start_response):
             r"""Create a request token and return its attributes urlencoded"""
-            token = self.manager.create_request_token(env['consumer'],
+            manager = env.get('manager', self.manager)
+            token = manager.create_request_token(env['consumer'],
                 env['identity']['oauth_callback'])
             start_response('200 OK', [
                 ('Content-Type', 'application/x-www-form-urlencoded')
@@ -221,7 +508,11 @@ class OAuthPlugin(object):
             r"""Create an access token using the request token and return its
             attributes urlencoded
             """
-            atoken = self.manager.create_access_token(env.get('token'))
+            manager = env.get('manager', self.manager)
+            atoken = manager.create_access_token(env.get('token'))
+            if atoken is None:
+                # The request token has been exchanged already
+                return HTTPUnauthorized()(environ, start_response)
             start_response('200 OK', [
                 ('Content-Type', 'application/x-www-form-urlencoded')
             ])
@@ -240,8 +531,7 @@ class OAuthPlugin(object):
             _verify_request,
         ],
         '3-legged': [
-            _get_consumer,
-            _get_access_token,
+            _get_consumer_and_access_token,
             _verify_request,
         ],
         'request-token': [
@@ -264,19 +554,36 @@ class OAuthPlugin(object):
 
     # IAuthenticator
     def authenticate(self, environ, identity):
+        if not self._is_protected(environ.get('PATH_INFO', '')):
+            return None
         # Detect the request type
         rtype = self._detect_request_type(environ, identity)
+        if self.metrics is not None:
+            start = time.time()
         # Prepare the common environment for the actions
         env = dict(environ=environ, identity=identity if identity else {})
+        timings = None
+        if self.timing:
+            # Time the validators and the manager calls (the validators and
+            # the token apps take the manager from env)
+            timings = self._timings(environ)
+            env['manager'] = TimedManager(self.manager, timings)
         failed = False
         # Iterate through the actions of the request type and let them validate
         # and modify the common environment
         for validator in self.request_types[rtype]:
-            if not validator(self, env):
-                failed = True
+            if timings is None:
+                valid = validator(self, env)
+            else:
+                valid = timings.call(validator.__name__, validator, self, env)
+            if not valid:
+                failed = validator
                 break
 
         if failed:
+            if self.metrics is not None:
+                self._validator_failures.inc((failed.__name__,))
+                self._count_request(rtype, 'rejected', start)
             # One validator failed. The failed validator may prevent the 401 if
             # it sets env['throw_401'] = False. If not then DIE!
             throw_401 = env.get('throw_401', True)
@@ -288,6 +595,7 @@ class OAuthPlugin(object):
 
             return
 
+        userid = None
         consumer = env.get('consumer')
         if consumer:
             # If the validators found a consumer then remember it in the environ
@@ -298,10 +606,22 @@ class OAuthPlugin(object):
             if token:
                 # If a token exists then it's a 3-legged request - return the
                 # associated userid
-                return token.userid
+                userid = token.userid
             else:
                 # Otherwise it's a 2-legged request - return the consumer key
-                return 'consumer:%s' % consumer.key
+                userid = 'consumer:%s' % consumer.key
+
+        if self.metrics is not None and not (rtype == 'non-oauth' and
+                environ.get(_COUNTED_KEY)):
+            # The non-oauth requests seen by identify are counted already
+            self._count_request(rtype,
+                'ignored' if consumer is None else 'authenticated', start)
+        return userid
+
+    def _count_request(self, rtype, outcome, start):
+        r"""Count the request outcome and its authentication time"""
+        self._requests.inc((rtype, outcome))
+        self._request_time.observe(time.time() - start, (rtype,))
 
 
     # IChallenger
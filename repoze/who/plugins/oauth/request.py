@@ -0,0 +1,116 @@
+r"""A native builder of the OAuth signature base string (RFC 5849, 3.4.1).
+It produces exactly what oauth2 does for the requests the plugin verifies, but
+constructs neither the full url nor the intermediate unicode copies of the
+parameters.
+"""
+from string import ascii_letters, digits
+from urllib import quote
+
+import oauth2
+
+
+# The characters left unescaped (RFC 5849, 3.6)
+_UNRESERVED = ascii_letters + digits + '-._~'
+
+# The percent-encoding of every byte, computed once
+_ESCAPES = dict((chr(i), '%%%02X' % i) for i in xrange(256))
+_ESCAPES.update((c, c) for c in _UNRESERVED)
+
+
+def _utf8(s):
+    r"""Encode unicode strings to utf-8, leave byte strings as they are"""
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def escape(s):
+    r"""Percent-encode a (unicode or utf-8 encoded) string"""
+    s = _utf8(s)
+    if not s.rstrip(_UNRESERVED):
+        # Nothing to escape
+        return s
+    return ''.join(map(_ESCAPES.__getitem__, s))
+
+
+def normalized_url(environ):
+    r"""Construct the base string URI (scheme, host, non default port and path)
+    of the request from the WSGI environ. Equals the oauth2 normalized url of
+    paste.request.construct_url(environ, with_query_string=False)"""
+    scheme = environ['wsgi.url_scheme']
+    if scheme not in ('http', 'https'):
+        raise ValueError('Unsupported URL scheme %s.' % scheme)
+    default_port = scheme == 'http' and '80' or '443'
+    host = environ.get('HTTP_HOST')
+    if host:
+        if ':' in host:
+            host, port = host.split(':', 1)
+            if port and port != default_port:
+                host += ':' + port
+    else:
+        host = environ['SERVER_NAME']
+        if environ['SERVER_PORT'] != default_port:
+            host += ':' + environ['SERVER_PORT']
+    return '%s://%s%s' % (scheme, host,
+        quote(environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')))
+
+
+def normalize_parameters(items):
+    r"""Normalize the (key, value) parameter pairs: drop oauth_signature, sort
+    them by the utf-8 encoded key and value and join them percent-encoded.
+    The values are strings or lists of strings (repeated parameters)."""
+    pairs = []
+    append = pairs.append
+    for key, value in items:
+        if key == 'oauth_signature':
+            continue
+        key = _utf8(key)
+        if isinstance(value, basestring):
+            append((key, _utf8(value)))
+        elif isinstance(value, (list, tuple)):
+            pairs.extend([(key, _utf8(item)) for item in value])
+        else:
+            append((key, str(value)))
+    # A single sort of the already filtered pairs
+    pairs.sort()
+    return '&'.join([escape(key) + '=' + escape(value)
+        for key, value in pairs])
+
+
+def signature_base_string(method, url, normalized_parameters):
+    r"""Join the request method, the base string URI and the normalized
+    parameters into the signature base string"""
+    # The normalized parameters are percent-encoded already: the only
+    # characters left to escape are the '%', '=' and '&'
+    return '&'.join((escape(method), escape(url),
+        _utf8(normalized_parameters).replace('%', '%25').replace('=', '%3D')
+            .replace('&', '%26')))
+
+
+class Request(oauth2.Request):
+    r"""An oauth2.Request built straight from the WSGI environ and the parsed
+    OAuth parameters. The parameters are taken as they are and normalized with
+    normalize_parameters when a signature method asks for them.
+    """
+
+    def __init__(self, method, url, parameters):
+        # Skip the oauth2.Request initialization - it converts every parameter
+        # to unicode and parses the url
+        dict.__init__(self, parameters)
+        self.method = method
+        # The url has no query string - it is the normalized url itself
+        self.__dict__['url'] = url
+        self.normalized_url = url
+        self.body = ''
+        self.is_form_encoded = False
+
+    @classmethod
+    def from_environ(cls, environ, parameters):
+        r"""Construct the request of the WSGI environ with the given (already
+        parsed) parameters"""
+        return cls(environ['REQUEST_METHOD'], normalized_url(environ),
+            parameters)
+
+    def get_normalized_parameters(self):
+        r"""Return the normalized parameters to sign"""
+        return normalize_parameters(self.iteritems())
@@ -29,30 +29,127 @@ except ImportError:
 
 
 from oauth2 import SignatureMethod
+import oauth2
+
+from .cache import LRUCache
+from .executor import TimeoutError, rsa_verify
+from .request import escape, signature_base_string
+
+
+class SignatureMethod_HMAC_SHA1(oauth2.SignatureMethod_HMAC_SHA1):
+    r"""The oauth2 HMAC-SHA1 signature method with the base string and key
+    built by the native request helpers. The HMAC objects keyed with the
+    consumer and token secrets are kept in a bounded cache and copied for each
+    signature.
+
+    For initialization it takes:
+    - key_cache_size - (optional) the number of keyed HMAC objects to keep.
+      Default - 1000.
+    """
+
+    def __init__(self, key_cache_size=1000):
+        # The keyed HMAC objects by (consumer secret, token secret). The
+        # secrets only are kept - not the consumer and token objects
+        self.keys = LRUCache(size=key_cache_size)
+
+    def _key(self, consumer, token):
+        r"""Construct the HMAC key of the consumer and token secrets"""
+        key = escape(consumer.secret) + '&'
+        if token:
+            key += escape(token.secret)
+        return key
+
+    def _keyed_hmac(self, consumer, token):
+        r"""Return the (cached) HMAC object keyed for the consumer and token.
+        It must be copied before use"""
+        secrets = (consumer.secret, token.secret if token else None)
+        keyed = self.keys.get(secrets)
+        if keyed is None:
+            keyed = hmac.new(self._key(consumer, token), digestmod=sha)
+            self.keys.set(secrets, keyed)
+        return keyed
+
+    def signing_base(self, request, consumer, token):
+        if getattr(request, 'normalized_url', None) is None:
+            raise ValueError("Base URL for request is not set.")
+
+        raw = signature_base_string(request.method, request.normalized_url,
+            request.get_normalized_parameters())
+        return self._key(consumer, token), raw
+
+    def sign(self, request, consumer, token):
+        """Builds the base signature string."""
+        if getattr(request, 'normalized_url', None) is None:
+            raise ValueError("Base URL for request is not set.")
+
+        raw = signature_base_string(request.method, request.normalized_url,
+            request.get_normalized_parameters())
+        hashed = self._keyed_hmac(consumer, token).copy()
+        hashed.update(raw)
+        # Calculate the digest base 64.
+        return binascii.b2a_base64(hashed.digest())[:-1]
+
+
+# The DER encoded DigestInfo prefix of the SHA1 digests (PKCS #1)
+SHA1_DIGESTINFO = '\x30\x21\x30\x09\x06\x05\x2b\x0e\x03\x02\x1a\x05\x00\x04\x14'
 
 
 class SignatureMethod_RSA_SHA1(SignatureMethod):
+    r"""The RSA-SHA1 signature method.
+    The consumer RSA keys are taken from the PEM encoded consumer.rsa_key (see
+    the consumer_rsa_keys option of the DefaultManager) if available. They are
+    imported once and kept in a bounded cache. Consumers without the rsa_key
+    are expected to hold an imported key object in consumer.secret. The
+    signatures of the consumers without a usable key never check.
+
+    For initialization it takes:
+    - key_cache_size - (optional) the number of imported keys to keep. Default
+      - 1000.
+    - executor - (optional) a VerificationExecutor to run the signature checks
+      in. The checks not completed within its timeout fail. Default - None, the
+      checks run in the calling thread.
+    """
     name = 'RSA-SHA1'
 
+    # The emsa-pkcs1-v1_5 padding prefixes by the modulus and digest sizes
+    _prefixes = {}
+
+    def __init__(self, key_cache_size=1000, executor=None):
+        # The imported keys by their PEM encoding
+        self.keys = LRUCache(size=key_cache_size)
+        self.executor = executor
+
+    def _get_key(self, consumer):
+        r"""Return the (cached) RSA key object of the consumer or None if the
+        consumer has no usable key"""
+        pem = getattr(consumer, 'rsa_key', None)
+        if not pem:
+            # Set up by the custom glue code. A plain secret is not a key
+            key = consumer.secret
+            return key if hasattr(key, 'n') else None
+        key = self.keys.get(pem)
+        if key is None:
+            if RSA is None: raise NotImplementedError, self.name
+            key = RSA.importKey(pem)
+            self.keys.set(pem, key)
+        return key
+
     def signing_base(self, request, consumer, token):
-        if request.normalized_url is None:
+        if getattr(request, 'normalized_url', None) is None:
             raise ValueError("Base URL for request is not set.")
 
-        sig = (
-            escape(request.method),
-            escape(request.normalized_url),
-            escape(request.get_normalized_parameters()),
-        )
-
-        key = consumer.secret
-        raw = '&'.join(sig)
+        key = self._get_key(consumer)
+        raw = signature_base_string(request.method, request.normalized_url,
+            request.get_normalized_parameters())
         return key, raw
 
     def sign(self, request, consumer, token):
         """Builds the base signature string."""
         if RSA is None: raise NotImplementedError, self.name
         key, raw = self.signing_base(request, consumer, token)
-        
+        if key is None:
+            raise ValueError('No RSA key for the consumer.')
+
         digest = sha(raw).digest()
         sig = key.sign(self._pkcs1imify(key, digest), '')[0]
         sig_bytes = long_to_bytes(sig)
@@ -61,27 +158,49 @@ class SignatureMethod_RSA_SHA1(SignatureMethod):
 
     def check(self, request, consumer, token, signature):
         """Returns whether the given signature is the correct signature for
-        the given consumer and token signing the given request."""
-        if RSA is None: raise NotImplementedError, self.name
+        the given consumer and token signing the given request.
+        Returns False (rather than raising) if there is no RSA backend or key
+        or the signature can not be decoded."""
+        if RSA is None:
+            return False
         key, raw = self.signing_base(request, consumer, token)
+        if key is None:
+            return False
 
         digest = sha(raw).digest()
-        sig = bytes_to_long(binascii.a2b_base64(signature))
+        try:
+            sig = long(binascii.hexlify(binascii.a2b_base64(signature)) or
+                '0', 16)
+        except (binascii.Error, TypeError, ValueError):
+            # Not base64
+            return False
         data = self._pkcs1imify(key, digest)
         
-        pubkey = key.publickey()
-        return pubkey.verify(data, (sig,))
-
-    @staticmethod
-    def _pkcs1imify(key, data):
+        if self.executor is None:
+            # The verification needs the public part of the key only
+            return key.verify(data, (sig,))
+        try:
+            if self.executor.processes:
+                # Only the plain numbers travel to the worker process
+                return self.executor.call(rsa_verify, key.n, key.e, data, sig)
+            return self.executor.call(key.verify, data, (sig,))
+        except TimeoutError:
+            return False
+
+    @classmethod
+    def _pkcs1imify(cls, key, data):
         """Adapted from paramiko
 
         turn a 20-byte SHA1 hash into a blob of data as large as the key's N,
         using PKCS1's \"emsa-pkcs1-v1_5\" encoding.  totally bizarre.
-        """
-        SHA1_DIGESTINFO = '\x30\x21\x30\x09\x06\x05\x2b\x0e\x03\x02\x1a\x05\x00\x04\x14'
-        size = len(long_to_bytes(key.n))
-        filler = '\xff' * (size - len(SHA1_DIGESTINFO) - len(data) - 3)
-        return '\x00\x01' + filler + '\x00' + SHA1_DIGESTINFO + data
-        
 
+        The padding depends on the key size only and is computed once per size.
+        """
+        # The modulus size in bytes
+        size = (key.n.bit_length() + 7) // 8
+        prefix = cls._prefixes.get((size, len(data)))
+        if prefix is None:
+            filler = '\xff' * (size - len(SHA1_DIGESTINFO) - len(data) - 3)
+            prefix = cls._prefixes[(size, len(data))] = \
+                '\x00\x01' + filler + '\x00' + SHA1_DIGESTINFO
+        return prefix + data
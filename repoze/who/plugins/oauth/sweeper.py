@@ -0,0 +1,50 @@
+import logging
+from threading import Event, Thread
+
+log = logging.getLogger(__name__)
+
+
+class TokenSweeper(object):
+    r"""A background thread that periodically deletes expired tokens using
+    manager.sweep_expired_tokens.
+
+    For initialization it takes:
+    - manager - a DefaultManager (or anything with sweep_expired_tokens).
+    - interval - the number of seconds between the sweeps.
+
+    The results of the last sweep can be found in manager.last_sweep.
+    """
+
+    def __init__(self, manager, interval):
+        self.manager = manager
+        self.interval = interval
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        r"""Start sweeping in a daemon thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = Thread(target=self.run, name='oauth-token-sweeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        r"""Stop sweeping and wait for the thread to finish"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self):
+        r"""Sweep every interval seconds until stopped"""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.manager.sweep_expired_tokens()
+            except Exception:
+                # A failed sweep (e.g. database unavailable) should not kill
+                # the sweeper. Try again after the interval
+                log.exception('OAuth token sweep failed')
+            finally:
+                self.manager.DBSession.remove()
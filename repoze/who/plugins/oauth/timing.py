@@ -0,0 +1,59 @@
+r"""Per-stage wall time instrumentation of the request processing."""
+import time
+
+
+class Timings(object):
+    r"""Records the wall time of the request processing stages as (stage,
+    seconds) pairs and reports each of them to an optional sink.
+
+    For initialization it takes:
+    - stages - the list to append the (stage, seconds) pairs to.
+    - sink - (optional) a callable taking the environ, stage name and seconds.
+      Default - None.
+    - environ - (optional) the WSGI environment passed to the sink.
+    - timer - (optional) a function returning the current time in seconds.
+      Default - time.time.
+    """
+
+    def __init__(self, stages, sink=None, environ=None, timer=time.time):
+        self.stages = stages
+        self.sink = sink
+        self.environ = environ
+        self.timer = timer
+
+    def record(self, stage, seconds):
+        r"""Remember the time a stage took and report it to the sink"""
+        self.stages.append((stage, seconds))
+        if self.sink is not None:
+            self.sink(self.environ, stage, seconds)
+
+    def call(self, stage, func, *args, **kwargs):
+        r"""Call func(*args, **kwargs) and record the time it took under the
+        stage name. The time is recorded even if func raises"""
+        start = self.timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(stage, self.timer() - start)
+
+
+class TimedManager(object):
+    r"""A manager proxy recording the time of the manager method calls (as
+    'manager.<method name>' stages).
+
+    For initialization it takes:
+    - manager - the manager to proxy.
+    - timings - the Timings to record the calls in.
+    """
+
+    def __init__(self, manager, timings):
+        self._manager = manager
+        self._timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            return self._timings.call('manager.' + name, attr, *args, **kwargs)
+        return timed
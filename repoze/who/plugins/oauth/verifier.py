@@ -0,0 +1,97 @@
+r"""A lean replacement for oauth2.Server request verification."""
+import binascii
+import hmac
+import time
+
+import oauth2
+
+from .request import _utf8
+
+
+def _compare_digest(a, b):
+    r"""Compare two strings in a time independent of where they differ"""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+# Python >= 2.7.7 has it built in
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+# The errors of the signature methods on malformed signatures or unusable keys
+_signature_errors = (oauth2.Error, binascii.Error, AttributeError, KeyError,
+    NotImplementedError, TypeError, ValueError)
+
+# The oauth2 check - compares the signature built with the one given
+_sign_and_compare = oauth2.SignatureMethod.check.im_func
+
+
+class Verifier(object):
+    r"""Verifies the version, timestamp and signature of OAuth requests like
+    oauth2.Server does, but returns False instead of raising on the failure
+    paths and compares the signatures in constant time.
+
+    For initialization it takes:
+    - signature_methods - (optional) a dict of the supported oauth2 signature
+      methods by name.
+    - timer - (optional) a function returning the current time in seconds.
+      Default - time.time.
+    """
+
+    # Reject the requests older than this (in seconds)
+    timestamp_threshold = 300
+    version = oauth2.OAUTH_VERSION
+
+    def __init__(self, signature_methods=None, timer=time.time):
+        self.signature_methods = signature_methods or {}
+        self.timer = timer
+
+    def add_signature_method(self, signature_method):
+        r"""Add a supported signature method (as oauth2.Server does)"""
+        self.signature_methods[signature_method.name] = signature_method
+        return self.signature_methods
+
+    def check_request(self, request, consumer, token):
+        r"""Check the request version, timestamp and signature. Return True if
+        the request is valid or False otherwise"""
+        # The version is optional
+        version = request.get('oauth_version')
+        if version and version != self.version:
+            return False
+
+        # Both the timestamp and nonce are required
+        timestamp = request.get('oauth_timestamp')
+        if not timestamp or not timestamp.isdigit() or \
+                'oauth_nonce' not in request:
+            return False
+        if int(self.timer()) - int(timestamp) > self.timestamp_threshold:
+            # Expired
+            return False
+
+        signature = request.get('oauth_signature')
+        method = self.signature_methods.get(
+            request.get('oauth_signature_method'))
+        if signature is None or method is None:
+            return False
+
+        try:
+            if getattr(method.check, 'im_func', None) is _sign_and_compare:
+                # Build the signature ourselves to compare it in constant time
+                return compare_digest(
+                    _utf8(method.sign(request, consumer, token)),
+                    _utf8(signature))
+            # The signature methods with their own checks (e.g. RSA-SHA1)
+            return bool(method.check(request, consumer, token, signature))
+        except _signature_errors:
+            # A malformed signature or a consumer without a usable key
+            return False
+
+    def verify_request(self, request, consumer, token):
+        r"""An oauth2.Server compatible verification. Raises oauth2.Error if
+        the request is not valid, returns the non-oauth parameters otherwise"""
+        if not self.check_request(request, consumer, token):
+            raise oauth2.Error('Invalid request.')
+        return request.get_nonoauth_parameters()
@@ -0,0 +1,86 @@
+r"""Micro benchmarks of the OAuth plugin hot paths.
+
+Run with:
+
+    $ python -m tests.benchmark
+"""
+from StringIO import StringIO
+from timeit import Timer
+
+
+def make_plugin(**kwargs):
+    from repoze.who.plugins.oauth import OAuthPlugin
+    return OAuthPlugin(engine='sqlite:///:memory:', **kwargs)
+
+
+def non_oauth_environ():
+    r"""A typical cookie authenticated request"""
+    return {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': '/some/page',
+        'QUERY_STRING': 'page=2&sort=name',
+        'HTTP_COOKIE': 'auth_tkt=abcdef',
+        'wsgi.input': StringIO(),
+        'wsgi.version': (1, 0),
+    }
+
+
+def bench_non_oauth_identify(plugin, number=100000):
+    r"""The cost of identify for a cookie authenticated (non-OAuth) request"""
+    environ = non_oauth_environ()
+    return Timer(lambda: plugin.identify(environ)).timeit(number) / number
+
+
+def bench_full_parse(plugin, number=100000):
+    r"""The cost of parsing the same non-OAuth request without the fast path"""
+    environ = non_oauth_environ()
+    return Timer(lambda: plugin._parse_params(environ)).timeit(number) / number
+
+
+def signed_env():
+    r"""A signed 2-legged request as the validators see it"""
+    import oauth2
+    consumer = oauth2.Consumer('some-consumer', 'some-secret')
+    req = oauth2.Request.from_consumer_and_token(consumer, None,
+        http_method='GET', http_url='http://www.example.com/app')
+    req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), consumer, None)
+    environ = non_oauth_environ()
+    environ.update({
+        'wsgi.url_scheme': 'http',
+        'SERVER_NAME': 'www.example.com',
+        'SERVER_PORT': '80',
+        'PATH_INFO': '/app',
+    })
+    return dict(environ=environ, consumer=consumer, identity=dict(
+        (str(key), str(value)) for key, value in req.iteritems()))
+
+
+def bench_verify_request(plugin, number=10000):
+    r"""The cost of the signature verification. The same request is verified
+    over and over so the plugin must not reject replays"""
+    env = signed_env()
+    assert plugin._verify_request(env)
+    duration = Timer(lambda: plugin._verify_request(env)).timeit(number)
+    # Make sure the successful path was timed
+    assert plugin._verify_request(env)
+    return duration / number
+
+
+# The benchmarks and the plugin options to run them with
+BENCHMARKS = [
+    ('non_oauth_identify', bench_non_oauth_identify, {}),
+    ('full_parse', bench_full_parse, {}),
+    ('verify_request', bench_verify_request, dict(nonce_store='')),
+    ('verify_request_native', bench_verify_request,
+        dict(nonce_store='', native_verifier=True)),
+]
+
+
+def main():
+    for name, bench, options in BENCHMARKS:
+        print '%-28s %8.3f us/request' % (name,
+            bench(make_plugin(**options)) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import unittest
+
+
+class TestLRUCache(unittest.TestCase):
+    r"""Tests for the in-process cache"""
+
+    def _makeOne(self, **kargs):
+        from repoze.who.plugins.oauth.cache import LRUCache
+        # Control the time
+        self.now = 1000.0
+        return LRUCache(timer=lambda: self.now, **kargs)
+
+    def test_ttl(self):
+        r"""Test that the entries expire"""
+        cache = self._makeOne(size=10, ttl=60)
+        cache.set('a', 1)
+        # A per-entry ttl overrides the default one
+        cache.set('b', 2, ttl=10)
+        self.assertEquals((cache.get('a'), cache.get('b')), (1, 2))
+
+        self.now += 30
+        self.assertEquals((cache.get('a'), cache.get('b')), (1, None))
+
+        self.now += 30
+        self.assertEquals(cache.get('a', 'default'), 'default')
+        self.assertEquals((cache.hits, cache.misses), (3, 2))
+
+    def test_lru(self):
+        r"""Test that the least recently used entries are evicted"""
+        cache = self._makeOne(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch 'a' so that 'b' becomes the least recently used one
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals((cache.get('a'), cache.get('c')), (1, 3))
+
+        # Invalidation
+        cache.invalidate('a')
+        cache.invalidate('no-such-key')
+        self.assertEquals(cache.get('a'), None)
+
+        # A zero sized cache stores nothing
+        cache = self._makeOne(size=0)
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), None)
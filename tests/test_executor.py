@@ -0,0 +1,63 @@
+import time
+import unittest
+
+
+def fail():
+    raise ValueError('failed')
+
+
+class TestVerificationExecutor(unittest.TestCase):
+    r"""Tests for the signature check worker pool"""
+
+    def _makeOne(self, **kargs):
+        from repoze.who.plugins.oauth.executor import VerificationExecutor
+        executor = VerificationExecutor(**kargs)
+        self.addCleanup(executor.close)
+        return executor
+
+    def _wait_completed(self, executor, completed):
+        r"""The completion is accounted in the pool result thread"""
+        for i in xrange(100):
+            if executor.completed >= completed:
+                break
+            time.sleep(0.01)
+
+    def test_rsa_verify(self):
+        r"""Test the pure python RSA signature verification"""
+        from repoze.who.plugins.oauth.executor import rsa_verify
+        # A textbook RSA key
+        n, e, d = 3233, 17, 2753
+        data = '\x01\x02'
+        signature = pow(0x102, d, n)
+        self.assertTrue(rsa_verify(n, e, data, signature))
+        self.assertFalse(rsa_verify(n, e, '\x01\x03', signature))
+        self.assertFalse(rsa_verify(n, e, data, signature + 1))
+        self.assertFalse(rsa_verify(n, e, data, n + signature))
+
+    def test_processes(self):
+        r"""Test the calls in worker processes"""
+        from repoze.who.plugins.oauth.executor import rsa_verify
+        executor = self._makeOne(workers=1, processes=True)
+        self.assertEquals(executor.stats()['submitted'], 0)
+        n, e, d = 3233, 17, 2753
+        self.assertTrue(executor.call(rsa_verify, n, e, '\x01\x02',
+            pow(0x102, d, n)))
+        self.assertFalse(executor.call(rsa_verify, n, e, '\x01\x02', 1))
+        # The exceptions are raised in the caller
+        self.assertRaises(ValueError, executor.call, fail)
+        self._wait_completed(executor, 3)
+        self.assertEquals(executor.stats(), dict(depth=0, max_depth=1,
+            submitted=3, completed=3, timeouts=0, errors=1))
+
+    def test_threads_and_timeout(self):
+        r"""Test the calls in worker threads and the timeout"""
+        from multiprocessing import TimeoutError
+        executor = self._makeOne(workers=1, processes=False, timeout=0.05)
+        self.assertEquals(executor.call(max, 1, 2), 2)
+        self.assertRaises(TimeoutError, executor.call, time.sleep, 0.2)
+        # The slow call still occupies the only worker
+        self.assertEquals(executor.depth, 1)
+        self._wait_completed(executor, 2)
+        stats = executor.stats()
+        self.assertEquals((stats['depth'], stats['completed'],
+            stats['timeouts']), (0, 2, 1))
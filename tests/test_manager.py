@@ -171,6 +171,92 @@ class TestOAuthDefaultManager(ManagerTester):
             MyAccessToken, orphans=False)
 
 
+    def test_consumer_rsa_keys(self):
+        r"""Test that the manager can add the RSA key column to consumers"""
+        from repoze.who.plugins.oauth import DefaultManager, Consumer
+        # Drop the tables created without the column
+        self.metadata.drop_all(tables=[
+            Consumer.__table__,
+            self.manager.RequestToken.__table__,
+            self.manager.AccessToken.__table__,
+        ])
+        manager = DefaultManager(engine=self.engine, consumer_rsa_keys='true')
+        self.assertTrue(hasattr(Consumer, 'rsa_key'))
+
+        pem = '-----BEGIN PUBLIC KEY-----\n%s\n-----END PUBLIC KEY-----' % \
+            ('A' * 64)
+        self.session.add(Consumer(key='rsa-consumer', secret='',
+            rsa_key=pem))
+        self.session.flush()
+        self.assertEquals(manager.get_consumer_by_key('rsa-consumer').rsa_key,
+            pem)
+
+
+    def test_consumer_deletion(self):
+        r"""Test that the tokens are deleted by the database together with their
+        consumer"""
+        from repoze.who.plugins.oauth import (DefaultManager, Consumer,
+            RequestToken, AccessToken)
+        manager = DefaultManager(engine=self.engine)
+
+        for key in ('consumer1', 'consumer2'):
+            consumer = Consumer(key=key, secret='secret')
+            self.session.add(consumer)
+            self.session.add_all([RequestToken(key='%s-r%s' % (key, i),
+                secret='secret', consumer=consumer) for i in range(5)])
+            self.session.add_all([AccessToken(key='%s-a%s' % (key, i),
+                secret='secret', userid=u'some-user', consumer=consumer)
+                for i in range(5)])
+        self.session.flush()
+        self.session.expunge_all()
+
+        # Count the queries issued from now on
+        queries = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            lambda *args: queries.append(args[2]))
+
+        # Deleting through the ORM does not load the tokens
+        consumer = self.session.query(Consumer).get('consumer1')
+        self.session.delete(consumer)
+        self.session.flush()
+        self.assertEquals([q for q in queries if 'tokens' in q], [])
+        self.assertEquals(self.session.query(RequestToken).count(), 5)
+        self.assertEquals(self.session.query(AccessToken).count(), 5)
+
+        # The manager deletes a consumer with a single statement
+        self.assertEquals(manager.get_consumer_by_key('consumer2').key,
+            'consumer2')
+        del queries[:]
+        self.assertTrue(manager.delete_consumer('consumer2'))
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(self.session.query(RequestToken).count(), 0)
+        self.assertEquals(self.session.query(AccessToken).count(), 0)
+        # The consumer is not cached any more
+        self.assertEquals(manager.get_consumer_by_key('consumer2'), None)
+        self.assertFalse(manager.delete_consumer('consumer2'))
+
+
+    def test_random_strings(self):
+        r"""Test the random key, secret and verifier generator"""
+        from string import ascii_lowercase, digits
+        from repoze.who.plugins.oauth.model import (gen_random_string,
+            RandomStringGenerator)
+
+        keys = set(gen_random_string() for i in range(1000))
+        # All different and 40 chars long
+        self.assertEquals(len(keys), 1000)
+        self.assertEquals(set(map(len, keys)), set([40]))
+
+        # Only the alphabet characters are used
+        alphabet = ascii_lowercase + digits
+        chars = set(gen_random_string(length=5000, alphabet=alphabet))
+        self.assertEquals(chars, set(alphabet))
+
+        # Strings longer than the buffer are generated too
+        generator = RandomStringGenerator('ab', buffer_size=16)
+        self.assertEquals(set(generator(1000)), set('ab'))
+
+
     def test_token_creation(self):
         r"""Test token creation at the model level (not manager actually). Use
         an in-memory database"""
@@ -186,7 +272,7 @@ class TestOAuthDefaultManager(ManagerTester):
             session=self.session)
         # Check various attributes and relations
         self.assertEquals(req_token.consumer, cons1)
-        self.assertEquals(cons1.request_tokens, [req_token])
+        self.assertEquals(cons1.request_tokens.all(), [req_token])
         # We have exactly one token now
         self.assertEquals(len(list(self.session.query(RequestToken))), 1)
         self.assertEquals(len(req_token.key), 40)
@@ -196,7 +282,7 @@ class TestOAuthDefaultManager(ManagerTester):
         acc_token = AccessToken.create(cons1, u'some-user',
             session=self.session)
         self.assertNotEquals(acc_token.key, req_token.key)
-        self.assertEquals(cons1.access_tokens, [acc_token])
+        self.assertEquals(cons1.access_tokens.all(), [acc_token])
 
         # Let's try to create two tokens with the same key and test the unique
         # key requirement
@@ -205,8 +291,8 @@ class TestOAuthDefaultManager(ManagerTester):
         # We do not provide the session so the exception happens on flush
         self.assertRaises(sa.exc.IntegrityError, self.session.flush)
 
-        # However if we do provide the session, it will be flushed, the error
-        # will be caught and the key will be changed to a random string
+        # However if we do provide the session, the token will be inserted, the
+        # error will be caught and the key will be changed to a random string
         token1 = RequestToken.create(cons1, u'http://someurl.com',
             session=self.session, key='rtkey')
         token2 = RequestToken.create(cons1, u'http://someurl.com',
@@ -222,3 +308,382 @@ class TestOAuthDefaultManager(ManagerTester):
         self.session.delete(cons1)
         self.assertEquals(len(list(self.session.query(RequestToken))), 0)
         self.assertEquals(len(list(self.session.query(AccessToken))), 0)
+
+
+    def test_token_creation_does_not_load_tokens(self):
+        r"""Test that issuing a token does not load the existing tokens of the
+        consumer and costs a single INSERT"""
+        from repoze.who.plugins.oauth import DefaultManager, Consumer
+        manager = DefaultManager(engine=self.engine)
+
+        consumer = Consumer(key='consumer1', secret='secret1')
+        manager.DBSession.add(consumer)
+        for i in range(10):
+            manager.create_request_token(consumer, u'oob')
+            manager.create_access_token(
+                manager.set_request_token_user(
+                    manager.create_request_token(consumer, u'oob').key,
+                    u'some-user'))
+
+        consumer = manager.get_consumer_by_key('consumer1')
+        # Count the queries issued from now on
+        queries = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            lambda *args: queries.append(args[2]))
+        token = manager.create_request_token(consumer, u'oob')
+        # A single INSERT and nothing else
+        self.assertEquals(len(queries), 1)
+        self.assertTrue(queries[0].startswith('INSERT'))
+        self.assertEquals(consumer.request_tokens.count(), 11)
+        # The token is usable as if it was loaded
+        self.assertEquals(token.consumer, consumer)
+        self.assertEquals(token.userid, None)
+        self.assertTrue(token.created)
+        self.assertTrue(token in manager.DBSession)
+        self.assertFalse(manager.DBSession.dirty)
+
+
+    def test_consumer_cache(self):
+        r"""Test that the manager caches consumers"""
+        from repoze.who.plugins.oauth import DefaultManager, Consumer
+        manager = DefaultManager(engine=self.engine)
+        cache = manager.consumer_cache
+
+        # Create a sample consumer
+        self.session.add(Consumer(key='abcd', secret='abcdef'))
+        self.session.flush()
+
+        # The first lookup goes to the database
+        self.assertEquals(manager.get_consumer_by_key('abcd').secret, 'abcdef')
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+
+        # Count the queries issued from now on
+        queries = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            lambda *args: queries.append(args[2]))
+        # The second one is served from the cache
+        consumer = manager.get_consumer_by_key('abcd')
+        self.assertEquals(consumer.secret, 'abcdef')
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        self.assertEquals(queries, [])
+        # And the consumer can be used within the manager session
+        self.assertTrue(consumer in manager.DBSession)
+
+        # Modify the consumer outside of the manager
+        self.session.query(Consumer).filter_by(key='abcd').update(
+            dict(secret='ghijkl'))
+        # The manager does not know about it...
+        self.assertEquals(manager.get_consumer_by_key('abcd').secret, 'abcdef')
+        # ... until the consumer gets invalidated
+        manager.invalidate_consumer('abcd')
+        self.assertEquals(manager.get_consumer_by_key('abcd').secret, 'ghijkl')
+
+        # Missing consumers are not cached
+        self.assertEquals(manager.get_consumer_by_key('dcba'), None)
+        self.assertEquals(len(cache), 1)
+
+        # Clearing resets everything
+        manager.clear()
+        self.assertEquals((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+        # The cache can be disabled
+        manager = DefaultManager(engine=self.engine, consumer_cache_size=0)
+        self.assertEquals(manager.get_consumer_by_key('abcd').secret, 'ghijkl')
+        self.assertEquals(len(manager.consumer_cache), 0)
+
+
+    def test_access_token_cache(self):
+        r"""Test that the manager caches access token lookups"""
+        from repoze.who.plugins.oauth import (DefaultManager, Consumer,
+            AccessToken)
+        manager = DefaultManager(engine=self.engine)
+        cache = manager.access_token_cache
+
+        consumer = Consumer(key='abcd', secret='abcdef')
+        self.session.add(consumer)
+        self.session.flush()
+
+        # An unknown token is not found...
+        self.assertEquals(manager.get_access_token('token1', consumer), None)
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+        # ... and the failure is remembered
+        self.assertEquals(manager.get_access_token('token1', consumer), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+        # Even if the token appears behind the manager's back...
+        self.session.add(AccessToken(key='token1', secret='secret1',
+            userid=u'some-user', consumer_key='abcd'))
+        self.session.flush()
+        self.assertEquals(manager.get_access_token('token1', consumer), None)
+        # ... until invalidated
+        manager.invalidate_access_token('token1', 'abcd')
+        token = manager.get_access_token('token1', consumer)
+        self.assertEquals(token.userid, u'some-user')
+        # Now the token is served from the cache
+        self.assertEquals(manager.get_access_token('token1', consumer).key,
+            'token1')
+        self.assertEquals((cache.hits, cache.misses), (3, 2))
+
+        # The token is looked up for the given consumer only
+        other = Consumer(key='dcba', secret='fedcba')
+        self.assertEquals(manager.get_access_token('token1', other), None)
+
+        # Deleting the token through the manager invalidates the cache entry
+        manager.delete_access_token(token)
+        self.assertEquals(manager.get_access_token('token1', consumer), None)
+        self.assertEquals(len(list(self.session.query(AccessToken))), 0)
+
+
+    def test_get_consumer_and_access_token(self):
+        r"""Test how the manager finds a consumer and an access token at once"""
+        from repoze.who.plugins.oauth import (DefaultManager, Consumer,
+            AccessToken)
+
+        self.session.add(Consumer(key='abcd', secret='abcdef'))
+        self.session.add(AccessToken(key='token1', secret='secret1',
+            userid=u'some-user', consumer_key='abcd'))
+        self.session.flush()
+
+        # Count the queries
+        queries = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            lambda *args: queries.append(args[2]))
+
+        for cache_size in (0, 100):
+            manager = DefaultManager(engine=self.engine,
+                consumer_cache_size=cache_size,
+                access_token_cache_size=cache_size)
+            del queries[:]
+            # Both found with a single query
+            consumer, token = manager.get_consumer_and_access_token('abcd',
+                'token1')
+            self.assertEquals((consumer.key, token.key), ('abcd', 'token1'))
+            self.assertEquals(token.userid, u'some-user')
+            self.assertEquals(len(queries), 1)
+
+            # The consumer is found without the token
+            consumer, token = manager.get_consumer_and_access_token('abcd',
+                'token2')
+            self.assertEquals((consumer.key, token), ('abcd', None))
+            # Another consumer does not own the token
+            self.assertEquals(
+                manager.get_consumer_and_access_token('dcba', 'token1'),
+                (None, None))
+            self.assertEquals(len(queries), 3)
+
+        # The lookups fill in the caches and are served from them
+        del queries[:]
+        consumer, token = manager.get_consumer_and_access_token('abcd',
+            'token1')
+        self.assertEquals((consumer.key, token.key), ('abcd', 'token1'))
+        self.assertEquals(manager.get_access_token('token2', consumer), None)
+        self.assertEquals(queries, [])
+
+
+    def test_sweep_expired_tokens(self):
+        r"""Test how the manager deletes expired and stale tokens"""
+        from datetime import datetime, timedelta
+        import time
+        from repoze.who.plugins.oauth import (DefaultManager, Consumer,
+            RequestToken, AccessToken)
+        manager = DefaultManager(engine=self.engine, sweep_batch_size=2,
+            stale_request_token_age=3600)
+
+        now = datetime.now()
+        past = now - timedelta(minutes=1)
+        future = now + timedelta(minutes=1)
+        long_ago = now - timedelta(hours=2)
+        consumer = Consumer(key='consumer1', secret='secret1')
+        self.session.add(consumer)
+        tokens = [
+            # Expired
+            RequestToken(key='r1', secret='s', valid_till=past),
+            RequestToken(key='r2', secret='s', valid_till=past,
+                userid=u'some-user'),
+            # Stale and unauthorized
+            RequestToken(key='r3', secret='s', created=long_ago),
+            RequestToken(key='r4', secret='s', created=long_ago,
+                valid_till=future),
+            # Alive
+            RequestToken(key='r5', secret='s', valid_till=future),
+            RequestToken(key='r6', secret='s', created=long_ago,
+                userid=u'some-user'),
+            RequestToken(key='r7', secret='s'),
+        ]
+        tokens += [AccessToken(key='a%s' % i, secret='s', userid=u'some-user',
+            valid_till=past) for i in range(5)]
+        tokens += [
+            AccessToken(key='a5', secret='s', userid=u'some-user',
+                valid_till=future),
+            AccessToken(key='a6', secret='s', userid=u'some-user'),
+        ]
+        for token in tokens:
+            token.consumer = consumer
+        self.session.add_all(tokens)
+        self.session.flush()
+
+        swept = manager.sweep_expired_tokens()
+        self.assertEquals(swept, dict(request_tokens=2, stale_request_tokens=2,
+            access_tokens=5))
+        self.assertEquals(manager.last_sweep, swept)
+        self.assertEquals(sorted(t.key for t in
+            self.session.query(RequestToken)), ['r5', 'r6', 'r7'])
+        self.assertEquals(sorted(t.key for t in
+            self.session.query(AccessToken)), ['a5', 'a6'])
+
+        # Nothing left to sweep
+        self.assertEquals(manager.sweep_expired_tokens(),
+            dict(request_tokens=0, stale_request_tokens=0, access_tokens=0))
+
+        # The sweeping can be done in a background thread
+        self.session.add(AccessToken(key='a7', secret='s', userid=u'some-user',
+            valid_till=past, consumer=consumer))
+        self.session.flush()
+        manager = DefaultManager(engine=self.engine, sweep_interval=0.01)
+        try:
+            for i in range(100):
+                if manager.last_sweep:
+                    break
+                time.sleep(0.01)
+        finally:
+            manager.sweeper.stop()
+        self.assertEquals(manager.last_sweep['access_tokens'], 1)
+
+
+    def test_sweep_options(self):
+        r"""Test the sweep options as given in the config files"""
+        from repoze.who.plugins.oauth import DefaultManager
+        for value in ('None', 'none', '', None):
+            manager = DefaultManager(engine=self.engine, sweep_interval=value,
+                stale_request_token_age=value)
+            self.assertEquals(manager.stale_request_token_age, None)
+            self.assertEquals(manager.sweeper, None)
+        manager = DefaultManager(engine=self.engine,
+            stale_request_token_age='3600')
+        self.assertEquals(manager.stale_request_token_age, 3600.0)
+
+
+    def test_token_expiry(self):
+        r"""Test that only live tokens are found"""
+        from datetime import datetime, timedelta
+        from repoze.who.plugins.oauth import (DefaultManager, Consumer,
+            RequestToken, AccessToken)
+        manager = DefaultManager(engine=self.engine)
+
+        now = datetime.now()
+        past = now - timedelta(minutes=1)
+        future = now + timedelta(minutes=1)
+        consumer = Consumer(key='consumer1', secret='secret1')
+        self.session.add(consumer)
+        for key, valid_till in (('expired', past), ('alive', future),
+                ('permanent', None)):
+            self.session.add_all((
+                RequestToken(key='r-' + key, secret='s', valid_till=valid_till,
+                    consumer=consumer),
+                AccessToken(key='a-' + key, secret='s', userid=u'some-user',
+                    valid_till=valid_till, consumer=consumer),
+            ))
+        self.session.flush()
+
+        # Expired tokens are not found
+        self.assertEquals(manager.get_request_token('r-expired'), None)
+        self.assertEquals(manager.get_access_token('a-expired', consumer), None)
+        self.assertEquals(manager.get_consumer_and_access_token('consumer1',
+            'a-expired')[1], None)
+        # Non-expired ones are
+        for key in ('alive', 'permanent'):
+            self.assertEquals(manager.get_request_token('r-' + key).key,
+                'r-' + key)
+            self.assertEquals(manager.get_access_token('a-' + key,
+                consumer).key, 'a-' + key)
+            self.assertEquals(manager.get_consumer_and_access_token(
+                'consumer1', 'a-' + key)[1].key, 'a-' + key)
+        # An expired token can not be authorized
+        self.assertEquals(
+            manager.set_request_token_user('r-expired', u'some-user'), None)
+        self.assertEquals(
+            manager.set_request_token_user('r-alive', u'some-user').userid,
+            u'some-user')
+
+        # A token is not cached longer than it is valid
+        manager.clear()
+        token = self.session.query(AccessToken).get('a-alive')
+        token.valid_till = datetime.now() + timedelta(seconds=5)
+        self.session.flush()
+        manager.get_access_token('a-alive', consumer)
+        cache = manager.access_token_cache
+        expires = cache._data[('a-alive', 'consumer1')][1]
+        self.assertTrue(expires <= cache.timer() + 5)
+
+
+    def test_access_token_exchange(self):
+        r"""Test that a request token is exchanged for an access token at most
+        once"""
+        from repoze.who.plugins.oauth import (DefaultManager, Consumer,
+            RequestToken, AccessToken)
+        manager = DefaultManager(engine=self.engine)
+
+        consumer = Consumer(key='consumer1', secret='secret1')
+        manager.DBSession.add(consumer)
+        rtoken = manager.create_request_token(consumer, u'oob')
+        # An unauthorized request token can not be exchanged
+        self.assertEquals(manager.create_access_token(rtoken), None)
+        rtoken = manager.set_request_token_user(rtoken.key, u'some-user')
+        # Two concurrent exchanges hold the same request token
+        other_rtoken = manager.CacheSession().query(RequestToken).get(
+            rtoken.key)
+
+        # Count the queries issued from now on
+        queries = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            lambda *args: queries.append(args[2]))
+        atoken = manager.create_access_token(rtoken)
+        # The request token is consumed and the access token created by a
+        # DELETE and an INSERT
+        self.assertEquals([q.split()[0] for q in queries], ['DELETE', 'INSERT'])
+        self.assertEquals(atoken.userid, u'some-user')
+        self.assertEquals(atoken.consumer_key, 'consumer1')
+        self.assertFalse(rtoken in manager.DBSession)
+
+        # The second exchange fails
+        self.assertEquals(manager.create_access_token(other_rtoken), None)
+        self.assertEquals(self.session.query(RequestToken).count(), 0)
+        self.assertEquals([t.key for t in self.session.query(AccessToken)],
+            [atoken.key])
+        # The new token can be found
+        self.assertEquals(manager.get_access_token(atoken.key, consumer).key,
+            atoken.key)
+
+
+    def test_set_request_token_user(self):
+        r"""Test the request token authorization"""
+        from repoze.who.plugins.oauth import DefaultManager, Consumer
+        manager = DefaultManager(engine=self.engine)
+
+        consumer = Consumer(key='consumer1', secret='secret1')
+        manager.DBSession.add(consumer)
+        rtoken = manager.create_request_token(consumer, u'oob')
+
+        # Count the queries issued from now on
+        queries = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            lambda *args: queries.append(args[2]))
+        token = manager.set_request_token_user(rtoken.key, u'some-user')
+        # A single UPDATE does the job. SQLite does not support RETURNING so
+        # the token is selected afterwards
+        self.assertEquals([q.split()[0] for q in queries], ['UPDATE', 'SELECT'])
+        self.assertEquals(token.userid, u'some-user')
+        self.assertEquals(len(token.verifier), 6)
+        # The instance in the session is up to date
+        self.assertTrue(token is rtoken)
+
+        # The same user can authorize the token again. The verifier stays
+        verifier = token.verifier
+        token = manager.set_request_token_user(rtoken.key, u'some-user')
+        self.assertEquals(token.verifier, verifier)
+
+        # But another user can not
+        self.assertEquals(
+            manager.set_request_token_user(rtoken.key, u'another-user'), None)
+        self.assertEquals(manager.get_request_token(rtoken.key).userid,
+            u'some-user')
@@ -0,0 +1,69 @@
+import unittest
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    r"""Tests for the in-process metrics"""
+
+    def _makeOne(self):
+        from repoze.who.plugins.oauth.metrics import MetricsRegistry
+        return MetricsRegistry()
+
+    def test_counter(self):
+        r"""Test the counters and their rendering"""
+        metrics = self._makeOne()
+        counter = metrics.counter('requests_total', 'Requests.',
+            labels=('type', 'outcome'))
+        counter.inc(('2-legged', 'authenticated'))
+        counter.inc(('2-legged', 'authenticated'), amount=2)
+        counter.inc(('3-legged', 'say "hi"\n'))
+        self.assertEquals(counter.value(('2-legged', 'authenticated')), 3)
+        self.assertEquals(counter.value(('3-legged', 'authenticated')), 0)
+        # All the labels are required
+        self.assertRaises(ValueError, counter.inc, ('2-legged',))
+        # The same metric is returned for the name
+        self.assertTrue(metrics.counter('requests_total', 'Requests.',
+            labels=('type', 'outcome')) is counter)
+        self.assertRaises(ValueError, metrics.histogram, 'requests_total',
+            'Requests.')
+
+        self.assertEquals(metrics.render(),
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{type="2-legged",outcome="authenticated"} 3\n'
+            'requests_total{type="3-legged",outcome="say \\"hi\\"\\n"} 1\n')
+
+    def test_histogram(self):
+        r"""Test that the values are counted in cumulative buckets"""
+        metrics = self._makeOne()
+        histogram = metrics.histogram('query_seconds', 'Query time.',
+            buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEquals(histogram.value(), (4, 2.65))
+        self.assertEquals(metrics.render(),
+            '# HELP query_seconds Query time.\n'
+            '# TYPE query_seconds histogram\n'
+            'query_seconds_bucket{le="0.1"} 2\n'
+            'query_seconds_bucket{le="1"} 3\n'
+            'query_seconds_bucket{le="+Inf"} 4\n'
+            'query_seconds_sum 2.65\n'
+            'query_seconds_count 4\n')
+
+    def test_callback(self):
+        r"""Test that the callback metrics are read when rendered"""
+        metrics = self._makeOne()
+        values = {('consumer',): 1}
+        metrics.callback('cache_hits_total', 'Cache hits.', lambda: values,
+            labels=('cache',), type='counter')
+        metrics.callback('ratio', 'Ratio.', lambda: 0.5)
+        # A metric registered already is kept
+        metrics.callback('ratio', 'Ratio.', lambda: 1.0)
+        self.assertRaises(ValueError, metrics.counter, 'ratio', 'Ratio.')
+        values[('consumer',)] = 2
+        self.assertEquals(metrics.render(),
+            '# HELP cache_hits_total Cache hits.\n'
+            '# TYPE cache_hits_total counter\n'
+            'cache_hits_total{cache="consumer"} 2\n'
+            '# HELP ratio Ratio.\n'
+            '# TYPE ratio gauge\n'
+            'ratio 0.5\n')
@@ -0,0 +1,304 @@
+import time
+from threading import Thread
+import unittest
+
+import sqlalchemy as sa
+
+from .base import ManagerTester
+
+
+class TestMemoryNonceStore(unittest.TestCase):
+    r"""Tests for the in-process nonce store"""
+
+    def _makeOne(self, **kargs):
+        from repoze.who.plugins.oauth.nonces import MemoryNonceStore
+        # Control the time
+        self.now = 1000000
+        return MemoryNonceStore(timer=lambda: self.now, **kargs)
+
+    def test_replay(self):
+        r"""Test that the nonces are accepted once"""
+        store = self._makeOne()
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        self.assertFalse(store.add('consumer', None, self.now, 'abc'))
+        # The nonce is unique per consumer, token and timestamp only
+        self.assertTrue(store.add('consumer', 'token', self.now, 'abc'))
+        self.assertTrue(store.add('other-consumer', None, self.now, 'abc'))
+        self.assertTrue(store.add('consumer', None, self.now - 1, 'abc'))
+        self.assertEquals(len(store), 4)
+
+        # The timestamps outside of the window are rejected
+        self.assertFalse(store.add('consumer', None, self.now - 301, 'xyz'))
+        self.assertFalse(store.add('consumer', None, self.now + 301, 'xyz'))
+        self.assertTrue(store.add('consumer', None, self.now + 300, 'xyz'))
+
+    def test_buckets(self):
+        r"""Test that the buckets are dropped as they leave the window"""
+        store = self._makeOne(window=60, bucket_size=10)
+        for i in xrange(3):
+            self.assertTrue(store.add('consumer', None, self.now, str(i)))
+        self.assertTrue(store.add('consumer', None, self.now + 15, 'a'))
+        self.assertEquals(store.counts(), {self.now: 3, self.now + 10: 1})
+
+        # The first bucket is still in the window
+        self.now += 60
+        self.assertFalse(store.add('consumer', None, self.now - 60, '0'))
+        self.assertEquals(len(store), 4)
+        # But not any more
+        self.now += 10
+        self.assertTrue(store.add('consumer', None, self.now, 'b'))
+        self.assertEquals(store.counts(), {self.now - 60: 1, self.now: 1})
+        self.assertEquals(len(store), 2)
+
+    def test_max_nonces(self):
+        r"""Test that a full store shrinks the window instead of forgetting the
+        nonces it accepts"""
+        store = self._makeOne(window=60, bucket_size=10, max_nonces=3)
+        self.assertTrue(store.add('consumer', None, self.now - 30, 'a'))
+        self.assertTrue(store.add('consumer', None, self.now - 20, 'b'))
+        self.assertTrue(store.add('consumer', None, self.now, 'c'))
+        self.assertTrue(store.add('consumer', None, self.now, 'd'))
+        # The oldest bucket is gone
+        self.assertEquals(len(store), 3)
+        self.assertEquals(store.counts(), {self.now - 20: 1, self.now: 2})
+        # So its nonces can not be replayed
+        self.assertFalse(store.add('consumer', None, self.now - 30, 'a'))
+        self.assertFalse(store.add('consumer', None, self.now - 25, 'e'))
+        self.assertTrue(store.add('consumer', None, self.now - 20, 'e'))
+
+
+class TestBloomNonceStore(unittest.TestCase):
+    r"""Tests for the fixed size Bloom filter nonce store"""
+
+    def _makeOne(self, **kargs):
+        from repoze.who.plugins.oauth.nonces import BloomNonceStore
+        # Control the time
+        self.now = 1000000
+        return BloomNonceStore(timer=lambda: self.now, **kargs)
+
+    def test_sizing(self):
+        r"""Test that the filters are sized from the window, rate and error
+        rate"""
+        store = self._makeOne(window=300, rate=1000, error_rate=0.001)
+        # Two filters of 10 minutes of nonces each
+        self.assertEquals(store.capacity, 600000)
+        # Each filter is sized for half the error rate - about 15.8 bits per
+        # nonce
+        self.assertEquals(store.bits, 9492176)
+        self.assertEquals(store.hashes, 11)
+        self.assertEquals(store.memory_size, 2 * 9492176 / 8)
+        self.assertEquals((store.fill_ratio(), store.false_positive_rate()),
+            (0, 0))
+
+    def test_replay(self):
+        r"""Test that the nonces are accepted once"""
+        store = self._makeOne(window=60, rate=10, error_rate=0.01)
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        self.assertFalse(store.add('consumer', None, self.now, 'abc'))
+        # The nonce is unique per consumer, token and timestamp only
+        self.assertTrue(store.add('consumer', 'token', self.now, 'abc'))
+        self.assertTrue(store.add('other-consumer', None, self.now, 'abc'))
+        self.assertTrue(store.add('consumer', None, self.now - 1, 'abc'))
+        self.assertTrue(store.add(u'consumer', None, self.now, u'\xe9'))
+        self.assertFalse(store.add('consumer', None, self.now, '\xc3\xa9'))
+
+        # The timestamps outside of the window are rejected
+        self.assertFalse(store.add('consumer', None, self.now - 61, 'xyz'))
+        self.assertFalse(store.add('consumer', None, self.now + 61, 'xyz'))
+
+    def test_rotation(self):
+        r"""Test that the nonces are remembered as long as their timestamps are
+        accepted"""
+        store = self._makeOne(window=60, rate=10, error_rate=0.01)
+        timestamp = self.now + 60
+        self.assertTrue(store.add('consumer', None, timestamp, 'abc'))
+        fill_ratio = store.fill_ratio()
+        self.assertTrue(fill_ratio > 0)
+        # The filters are rotated
+        self.now += 119
+        self.assertFalse(store.add('consumer', None, timestamp, 'abc'))
+        self.now += 1
+        self.assertFalse(store.add('consumer', None, timestamp, 'abc'))
+        self.assertEquals(store.fill_ratio(), 0)
+        # Until the timestamp gets outdated
+        self.now += 1
+        self.assertFalse(store.add('consumer', None, timestamp, 'abc'))
+        # Both filters are empty after two more periods
+        self.now += 240
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        self.assertEquals(store.fill_ratio(), fill_ratio)
+        self.assertAlmostEquals(store.false_positive_rate(),
+            fill_ratio ** store.hashes)
+
+    def test_false_positive_rate(self):
+        r"""Test the false positive rate estimate at the capacity"""
+        store = self._makeOne(window=10, rate=100, error_rate=0.01)
+        accepted = sum(store.add('consumer', None, self.now, str(i))
+            for i in xrange(store.capacity))
+        # A few unused nonces are taken for replays
+        self.assertTrue(store.capacity * 0.99 < accepted < store.capacity)
+        self.assertTrue(0.4 < store.fill_ratio() < 0.6)
+        # A full filter takes half the error rate
+        self.assertTrue(0.003 < store.false_positive_rate() < 0.007)
+
+        # Both filters full stay about the error rate
+        self.now += store.period
+        accepted = sum(store.add('consumer', None, self.now, 'x%d' % i)
+            for i in xrange(store.capacity))
+        self.assertTrue(store.capacity * 0.98 < accepted < store.capacity)
+        self.assertTrue(0.007 < store.false_positive_rate() < 0.013)
+
+
+class TestSQLNonceStore(ManagerTester):
+    r"""Tests for the database nonce store"""
+
+    def _makeOne(self, **kargs):
+        from repoze.who.plugins.oauth.nonces import SQLNonceStore
+        # Control the time
+        self.now = 1000000
+        kargs.setdefault('batch_window', 0)
+        return SQLNonceStore(self.engine, timer=lambda: self.now, **kargs)
+
+    def _count(self, table):
+        return self.engine.execute(
+            sa.select([sa.func.count()], from_obj=table)).scalar()
+
+    def test_replay(self):
+        r"""Test that the nonces are accepted once"""
+        store = self._makeOne()
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        self.assertFalse(store.add('consumer', None, self.now, 'abc'))
+        # The nonce is unique per consumer, token and timestamp only
+        self.assertTrue(store.add('consumer', 'token', self.now, 'abc'))
+        self.assertTrue(store.add('other-consumer', None, self.now, 'abc'))
+        self.assertTrue(store.add('consumer', None, self.now - 1, 'abc'))
+        self.assertTrue(store.add('consumer', None, self.now, '\xc3\xa9'))
+        self.assertFalse(store.add('consumer', None, self.now, u'\xe9'))
+
+        # The nonces are shared by the stores using the same database
+        other_store = self._makeOne()
+        self.assertFalse(other_store.add('consumer', None, self.now, 'abc'))
+
+        # The timestamps outside of the window and too long nonces are rejected
+        self.assertFalse(store.add('consumer', None, self.now - 301, 'xyz'))
+        self.assertFalse(store.add('consumer', None, self.now + 301, 'xyz'))
+        self.assertFalse(store.add('consumer', None, self.now, 'x' * 101))
+
+    def test_partitions(self):
+        r"""Test that the tables of the outdated timestamps are emptied"""
+        store = self._makeOne(window=60, partition_size=30)
+        # Up to 5 slices in the window (on both sides), one to be emptied and
+        # a spare one
+        self.assertEquals(len(store.tables), 7)
+        self.now = 1000020
+        self.assertTrue(store.add('consumer', None, self.now - 60, 'abc'))
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        table = store._table(self.now - 60)
+        self.assertEquals(self._count(table), 1)
+
+        # The table is emptied as soon as it comes next after the window
+        self.now += 40
+        self.assertTrue(store.add('consumer', None, self.now, 'xyz'))
+        self.assertEquals(self._count(table), 1)
+        self.now += 30
+        self.assertTrue(store.add('consumer', None, self.now, 'xyz'))
+        self.assertEquals(self._count(table), 0)
+        self.assertEquals(sum(map(self._count, store.tables)), 3)
+
+        # A table missed while idle is not emptied once it is within the
+        # window again. The outdated nonce does not count as the timestamps
+        # differ
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        table = store._table(self.now)
+        count = self._count(table)
+        self.now += 150
+        self.assertTrue(store.add('consumer', None, self.now + 60, 'abc'))
+        self.assertTrue(store._table(self.now + 60) is table)
+        self.assertEquals(self._count(table), count + 1)
+        # It is emptied when it comes next again
+        self.now += 180
+        self.assertTrue(store.add('consumer', None, self.now, 'xyz'))
+        self.assertEquals(self._count(table), 0)
+
+    def test_empty(self):
+        r"""Test that the tables are emptied in a committed transaction"""
+        store = self._makeOne()
+        table = store.tables[0]
+        self.engine.execute(table.insert(), consumer_key='consumer',
+            token_key='', nonce='abc', timestamp=0)
+        events = []
+        def execute(conn, cursor, statement, *args):
+            events.append(statement.split()[0])
+        def commit(conn):
+            events.append('COMMIT')
+        sa.event.listen(self.engine, 'before_cursor_execute', execute)
+        sa.event.listen(self.engine, 'commit', commit)
+        store._empty(table)
+        self.assertEquals(events, ['DELETE', 'COMMIT'])
+        self.assertEquals(self._count(table), 0)
+
+    def test_shared_future_timestamps(self):
+        r"""Test that an idle store does not empty the tables other stores
+        write the nonces of the window in"""
+        store = self._makeOne()
+        idle_store = self._makeOne()
+        self.assertTrue(idle_store.add('consumer', None, self.now, 'xyz'))
+        self.now += 120
+        timestamp = self.now + 290
+        self.assertTrue(store.add('consumer', None, timestamp, 'abc'))
+        self.assertFalse(store.add('consumer', None, timestamp, 'abc'))
+        # The idle store catches up
+        self.now += 130
+        self.assertTrue(idle_store.add('consumer', None, self.now, 'def'))
+        # The replay is still rejected
+        self.assertFalse(store.add('consumer', None, timestamp, 'abc'))
+
+    def test_batches(self):
+        r"""Test that the concurrent calls are written together"""
+        store = self._makeOne(batch_window=0.2)
+        # Pretend another call is in progress so that the first call waits
+        # for the others
+        store._active = 1
+        statements = []
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('INSERT'):
+                statements.append(statement)
+        sa.event.listen(self.engine, 'before_cursor_execute', count)
+
+        results = {}
+        def add(i):
+            results[i] = store.add('consumer', None, self.now, str(i // 2))
+        threads = [Thread(target=add, args=(i,)) for i in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Each of the nonces is accepted once
+        self.assertEquals(sorted(results.values()), [False] * 5 + [True] * 5)
+        for i in xrange(0, 10, 2):
+            self.assertNotEquals(results[i], results[i + 1])
+        # Written by a single statement
+        self.assertEquals(len(statements), 1)
+
+        # A call on its own does not wait
+        store._active = 0
+        store.batch_window = 10
+        start = time.time()
+        self.assertTrue(store.add('consumer', None, self.now, 'abc'))
+        self.assertTrue(time.time() - start < 5)
+
+    def test_lookup_index(self):
+        r"""Test that the lookups by nonce use the index"""
+        store = self._makeOne()
+        table = store.tables[0]
+        plan = ' '.join(str(list(row)[-1]) for row in self.engine.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM %s WHERE nonce IN (?, ?)' %
+            table.name, ('abc', 'xyz')))
+        self.assertTrue('INDEX' in plan, plan)
+
+    def test_write_failure(self):
+        r"""Test that the nonces are rejected if they can not be written"""
+        store = self._makeOne()
+        store.tables[0].drop()
+        self.now = 0
+        self.assertFalse(store.add('consumer', None, 0, 'abc'))
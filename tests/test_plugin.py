@@ -99,6 +99,151 @@ class TestOAuthPlugin(ManagerTester):
         self.assertEquals(plugin._parse_params(environ), dict(params[1:]))
 
 
+    def test_parse_params_body(self):
+        r"""Test how the parameter parser treats the request body"""
+        plugin = self._makeOne(max_body_size=1000)
+
+        params = [
+            ('oauth_consumer_key', 'consumer_key'),
+            ('oauth_nonce', 'nonce'),
+        ]
+        pstr = urlencode(params + [('x', 'something')])
+
+        # The body is left for the downstream app to read
+        wsgi_input = StringIO(pstr)
+        environ = self._makeEnviron({
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded; charset=utf-8',
+            'CONTENT_LENGTH': str(len(pstr)),
+            'wsgi.input': wsgi_input,
+        })
+        self.assertEquals(plugin._parse_params(environ), dict(params))
+        # A seekable input is rewound rather than replaced
+        self.assertTrue(environ['wsgi.input'] is wsgi_input)
+        self.assertEquals(environ['wsgi.input'].read(), pstr)
+
+        # A non seekable input is replaced with the body read
+        class Input(object):
+            def __init__(self, data):
+                self.read = StringIO(data).read
+        environ['wsgi.input'] = Input(pstr)
+        self.assertEquals(plugin._parse_params(environ), dict(params))
+        self.assertEquals(environ['wsgi.input'].read(), pstr)
+
+        # Bodies larger than max_body_size are not looked into
+        pstr += '&' + urlencode([('y', 'x' * 1000)])
+        environ.update({
+            'CONTENT_LENGTH': str(len(pstr)),
+            'wsgi.input': StringIO(pstr),
+        })
+        self.assertEquals(plugin._parse_params(environ), {})
+        self.assertEquals(environ['wsgi.input'].read(), pstr)
+
+
+    def test_identify_memoizes_params(self):
+        r"""Test that the parameters are parsed once and kept in the environ"""
+        from repoze.who.plugins.oauth import PARAMS_KEY
+        plugin = self._makeOne()
+
+        environ = self._makeEnviron({
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': StringIO(),
+            'QUERY_STRING': 'oauth_token=abc&x=1',
+        })
+        identity = plugin.identify(environ)
+        self.assertEquals(identity, {'oauth_token': 'abc'})
+        self.assertEquals(environ[PARAMS_KEY], {'oauth_token': 'abc'})
+        # The identity is a copy - repoze.who may modify it
+        identity['repoze.who.userid'] = 'someone'
+        self.assertEquals(environ[PARAMS_KEY], {'oauth_token': 'abc'})
+
+        # The parameters are not parsed again
+        environ['QUERY_STRING'] = 'oauth_token=def'
+        self.assertEquals(plugin.identify(environ), {'oauth_token': 'abc'})
+
+        # Requests without OAuth parameters are remembered too
+        environ = self._makeEnviron({
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': StringIO(),
+            'QUERY_STRING': 'x=1&y=oauth_2',
+        })
+        self.assertEquals(plugin.identify(environ), None)
+        self.assertEquals(environ[PARAMS_KEY], {})
+
+
+    def test_non_oauth_fast_path(self):
+        r"""Test that the requests without any OAuth marker are not parsed"""
+        from repoze.who.plugins.oauth import PARAMS_KEY
+        from repoze.who.plugins.oauth.plugin import _has_oauth_marker
+        plugin = self._makeOne()
+
+        class Input(object):
+            def read(self, *args):
+                raise AssertionError('The body must not be read')
+
+        environ = self._makeEnviron({
+            'REQUEST_METHOD': 'POST',
+            'wsgi.input': Input(),
+            'QUERY_STRING': 'x=1',
+            'CONTENT_TYPE': 'multipart/form-data',
+            'CONTENT_LENGTH': '100',
+            'HTTP_AUTHORIZATION': 'Basic dXNlcjpwYXNz',
+        })
+        self.assertFalse(_has_oauth_marker(environ))
+        self.assertEquals(plugin.identify(environ), None)
+        self.assertFalse(PARAMS_KEY in environ)
+        # An empty form
+        environ.update(CONTENT_TYPE='application/x-www-form-urlencoded',
+            CONTENT_LENGTH='0')
+        self.assertFalse(_has_oauth_marker(environ))
+
+        # Any of the markers is enough
+        for marker in (
+                dict(HTTP_AUTHORIZATION='OAuth oauth_consumer_key="abc"'),
+                dict(HTTP_AUTHORIZATION=' oauth realm="x"'),
+                dict(QUERY_STRING='x=1&oauth_token=abc'),
+                dict(CONTENT_TYPE='application/x-www-form-urlencoded; '
+                    'charset=utf-8', CONTENT_LENGTH='10')):
+            env = dict(environ)
+            env.update(marker)
+            self.assertTrue(_has_oauth_marker(env), marker)
+
+    def test_protected_paths(self):
+        r"""Test that OAuth requests are processed under the protected paths
+        only"""
+        # All paths are protected by default
+        plugin = self._makeOne()
+        self.assertEquals(plugin.protected_paths, None)
+        self.assertTrue(plugin._is_protected('/anything'))
+
+        # The prefixes covered by shorter prefixes are dropped
+        plugin = self._makeOne(protected_paths='/api/v2/ /static/api/ /api/')
+        self.assertEquals(plugin.protected_paths, ['/api/', '/static/api/'])
+        self.assertTrue(plugin._is_protected('/api/'))
+        self.assertTrue(plugin._is_protected('/api/v2/users'))
+        self.assertTrue(plugin._is_protected('/static/api/x'))
+        self.assertFalse(plugin._is_protected('/'))
+        self.assertFalse(plugin._is_protected('/ap'))
+        self.assertFalse(plugin._is_protected('/apix'))
+        self.assertFalse(plugin._is_protected('/static/'))
+        self.assertFalse(plugin._is_protected('/zzz'))
+        # The token paths are always served
+        self.assertTrue(plugin._is_protected('/oauth/request_token'))
+        self.assertTrue(plugin._is_protected('/oauth/access_token'))
+
+        # Unprotected paths are neither identified nor authenticated
+        environ = self._makeEnviron({
+            'PATH_INFO': '/page',
+            'QUERY_STRING': 'oauth_consumer_key=abc',
+        })
+        self.assertEquals(plugin.identify(environ), None)
+        self.assertEquals(plugin.authenticate(environ,
+            {'oauth_consumer_key': 'abc'}), None)
+        environ['PATH_INFO'] = '/api/page'
+        self.assertEquals(plugin.identify(environ),
+            {'oauth_consumer_key': 'abc'})
+
+
     def test_request_type_detector(self):
         r"""Test that request type detector correctly detects request types"""
         plugin = self._makeOne()
@@ -363,12 +508,283 @@ class TestOAuthPlugin(ManagerTester):
         manager.DBSession.flush()
 
 
+    def test_get_consumer_and_access_token(self):
+        r"""Test how consumer and access token are fetched from the database
+        together"""
+        plugin = self._makeOne()
+        manager = plugin.manager
+
+        # Create a consumer and an access token in the DB
+        from repoze.who.plugins.oauth import Consumer
+        consumer = Consumer(key=u'some-consumer', secret='some-secret')
+        manager.DBSession.add(consumer)
+        rtoken = manager.create_request_token(consumer, 'http://test.com')
+        rtoken = manager.set_request_token_user(rtoken.key, u'some-user')
+        atoken = manager.create_access_token(rtoken)
+
+        # Both found
+        env = dict(environ={}, identity={
+            'oauth_consumer_key': 'some-consumer',
+            'oauth_token': atoken.key,
+        })
+        self.assertTrue(plugin._get_consumer_and_access_token(env))
+        self.assertEquals(env['consumer'].key, 'some-consumer')
+        self.assertEquals(env['token'].key, atoken.key)
+
+        # The token is not found but the consumer is
+        env = dict(environ={}, identity={
+            'oauth_consumer_key': 'some-consumer',
+            'oauth_token': atoken.key[:-1],
+        })
+        self.assertFalse(plugin._get_consumer_and_access_token(env))
+        self.assertEquals(env['consumer'].key, 'some-consumer')
+        self.assertFalse('token' in env)
+
+        # The consumer is not found
+        env = dict(environ={}, identity={
+            'oauth_consumer_key': 'another-consumer',
+            'oauth_token': atoken.key,
+        })
+        self.assertFalse(plugin._get_consumer_and_access_token(env))
+        self.assertFalse('consumer' in env)
+
+        # A manager without the combined lookup is also supported
+        class OldManager(object):
+            get_consumer_by_key = manager.get_consumer_by_key
+            get_access_token = manager.get_access_token
+        plugin.manager = OldManager()
+        env = dict(environ={}, identity={
+            'oauth_consumer_key': 'some-consumer',
+            'oauth_token': atoken.key,
+        })
+        self.assertTrue(plugin._get_consumer_and_access_token(env))
+        self.assertEquals(env['token'].key, atoken.key)
+
+        # Cleanup
+        manager.DBSession.delete(env['consumer'])
+        manager.DBSession.flush()
+
+
     def test_verify_request(self):
         r"""Test request verification.
         This is THE crucial part of the whole auth system
         """
+        self._test_verify_request(self._makeOne())
+
+    def test_verify_request_native(self):
+        r"""Test request verification with the native verifier"""
+        from repoze.who.plugins.oauth.verifier import Verifier
+        plugin = self._makeOne(native_verifier='true')
+        self.assertTrue(isinstance(plugin.server, Verifier))
+        self._test_verify_request(plugin)
+
+    def test_rsa_executor(self):
+        r"""Test that the RSA-SHA1 checks can be offloaded to workers"""
+        plugin = self._makeOne()
+        self.assertEquals(plugin.rsa_executor, None)
+        self.assertEquals(
+            plugin.server.signature_methods['RSA-SHA1'].executor, None)
+
+        plugin = self._makeOne(rsa_workers='2', rsa_worker_type='thread',
+            rsa_timeout='0.5')
+        executor = plugin.rsa_executor
+        self.assertEquals((executor.workers, executor.processes,
+            executor.timeout), (2, False, 0.5))
+        self.assertTrue(
+            plugin.server.signature_methods['RSA-SHA1'].executor is executor)
+        self.assertRaises(ValueError, self._makeOne, rsa_workers=1,
+            rsa_worker_type='fiber')
+
+    def test_nonce_store(self):
+        r"""Test that the replayed requests are rejected"""
+        from repoze.who.plugins.oauth import MemoryNonceStore
         plugin = self._makeOne()
+        self.assertTrue(isinstance(plugin.nonce_store, MemoryNonceStore))
+        self.assertEquals(plugin.nonce_store.window, 300)
+        # The store can be configured or disabled
+        plugin = self._makeOne(
+            nonce_store='repoze.who.plugins.oauth:MemoryNonceStore',
+            nonce_bucket_size='5')
+        self.assertEquals(plugin.nonce_store.bucket_size, 5)
+        self.assertEquals(self._makeOne(nonce_store='').nonce_store, None)
+        bloom_plugin = self._makeOne(
+            nonce_store='repoze.who.plugins.oauth:BloomNonceStore',
+            nonce_rate='10', nonce_error_rate='0.01')
+        self.assertEquals(bloom_plugin.nonce_store.capacity, 6000)
+        # The SQL store shares the manager database
+        sql_plugin = self._makeOne(
+            nonce_store='repoze.who.plugins.oauth:SQLNonceStore',
+            nonce_partition_size='30')
+        self.assertTrue(sql_plugin.nonce_store.engine is
+            sql_plugin.manager.metadata.bind)
+        self.assertEquals(sql_plugin.nonce_store.partition_size, 30)
 
+        consumer = oauth2.Consumer('some-consumer', 'some-secret')
+        token = oauth2.Token('some-token', 'some-secret')
+        for tok in (None, token):
+            req = oauth2.Request.from_consumer_and_token(
+                http_method='GET',
+                http_url='http://www.example.com/app',
+                consumer=consumer,
+                token=tok)
+            req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(),
+                consumer=consumer, token=tok)
+            env = dict(environ={
+                'REQUEST_METHOD': 'GET',
+                'wsgi.url_scheme': 'http',
+                'SERVER_NAME': 'www.example.com',
+                'SERVER_PORT': '80',
+                'PATH_INFO': '/app',
+            }, consumer=consumer, token=tok, identity=req)
+            self.assertTrue(plugin._verify_request(env))
+            # The same request again
+            self.assertFalse(plugin._verify_request(env))
+        self.assertEquals(len(plugin.nonce_store), 2)
+
+        # Requests with invalid signatures are not remembered
+        req['oauth_nonce'] = 'another-nonce'
+        self.assertFalse(plugin._verify_request(env))
+        self.assertEquals(len(plugin.nonce_store), 2)
+
+    def test_timing(self):
+        r"""Test that the stages are timed if enabled"""
+        from repoze.who.plugins.oauth import Consumer, TIMINGS_KEY
+        manager = self._makeOne().manager
+        consumer = Consumer(key=u'some-consumer', secret='some-secret')
+        manager.DBSession.add(consumer)
+        manager.DBSession.flush()
+        req = oauth2.Request.from_consumer_and_token(
+            http_method='GET',
+            http_url='http://www.example.com/app',
+            consumer=consumer)
+        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(),
+            consumer=consumer, token=None)
+        def make_environ():
+            return self._makeEnviron({
+                'REQUEST_METHOD': 'GET',
+                'wsgi.url_scheme': 'http',
+                'SERVER_NAME': 'www.example.com',
+                'SERVER_PORT': '80',
+                'PATH_INFO': '/app',
+                'QUERY_STRING': req.to_postdata(),
+            })
+
+        # Nothing is timed by default
+        plugin = self._makeOne()
+        environ = make_environ()
+        identity = plugin.identify(environ)
+        self.assertEquals(plugin.authenticate(environ, identity),
+            'consumer:some-consumer')
+        self.assertFalse(TIMINGS_KEY in environ)
+
+        reported = []
+        plugin = self._makeOne(timing='true',
+            timing_sink=lambda environ, stage, seconds: reported.append(
+                (environ, stage, seconds)))
+        self.assertTrue(plugin.timing)
+        environ = make_environ()
+        identity = plugin.identify(environ)
+        self.assertEquals(plugin.authenticate(environ, identity),
+            'consumer:some-consumer')
+        timings = environ[TIMINGS_KEY]
+        self.assertEquals([stage for stage, seconds in timings],
+            ['parse', 'manager.get_consumer_by_key', '_get_consumer',
+            '_verify_request'])
+        for stage, seconds in timings:
+            self.assertTrue(seconds >= 0)
+        # Every stage is reported to the sink
+        self.assertEquals(reported,
+            [(environ, stage, seconds) for stage, seconds in timings])
+
+        # The failed validators are timed as well
+        environ = make_environ()
+        identity = plugin.identify(environ)
+        identity['oauth_consumer_key'] = 'other-consumer'
+        self.assertEquals(plugin.authenticate(environ, identity), None)
+        self.assertEquals([stage for stage, seconds in environ[TIMINGS_KEY]],
+            ['parse', 'manager.get_consumer_by_key', '_get_consumer'])
+
+    def test_metrics(self):
+        r"""Test the request metrics and the metrics endpoint"""
+        from repoze.who.plugins.oauth import Consumer
+        self.assertEquals(self._makeOne().metrics, None)
+        plugin = self._makeOne(metrics_path='/metrics')
+        metrics = plugin.metrics
+        self.assertTrue(metrics is not None)
+        manager = plugin.manager
+        consumer = Consumer(key=u'some-consumer', secret='some-secret')
+        manager.DBSession.add(consumer)
+        manager.DBSession.flush()
+
+        def authenticate(consumer):
+            req = oauth2.Request.from_consumer_and_token(
+                http_method='GET',
+                http_url='http://www.example.com/app',
+                consumer=consumer)
+            req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(),
+                consumer=consumer, token=None)
+            environ = self._makeEnviron({
+                'REQUEST_METHOD': 'GET',
+                'wsgi.url_scheme': 'http',
+                'SERVER_NAME': 'www.example.com',
+                'SERVER_PORT': '80',
+                'PATH_INFO': '/app',
+                'QUERY_STRING': req.to_postdata(),
+            })
+            return plugin.authenticate(environ, plugin.identify(environ))
+
+        self.assertEquals(authenticate(consumer), 'consumer:some-consumer')
+        self.assertEquals(authenticate(consumer), 'consumer:some-consumer')
+        self.assertEquals(authenticate(
+            oauth2.Consumer('some-consumer', 'other-secret')), None)
+        self.assertEquals(authenticate(
+            oauth2.Consumer('other-consumer', 'some-secret')), None)
+        self.assertEquals(plugin.authenticate(self._makeEnviron({
+            'PATH_INFO': '/app'}), {}), None)
+        requests = metrics.get('oauth_requests_total')
+        self.assertEquals(requests.value(('non-oauth', 'ignored')), 1)
+        # The requests without OAuth parameters are counted by identify (as
+        # authenticate is not called for them) but only once
+        environ = self._makeEnviron({'PATH_INFO': '/app',
+            'QUERY_STRING': 'x=1'})
+        self.assertEquals(plugin.identify(environ), None)
+        self.assertEquals(plugin.identify(environ), None)
+        self.assertEquals(requests.value(('non-oauth', 'ignored')), 2)
+        self.assertEquals(plugin.authenticate(environ, {'login': 'x'}), None)
+        self.assertEquals(requests.value(('non-oauth', 'ignored')), 2)
+
+        self.assertEquals(requests.value(('2-legged', 'authenticated')), 2)
+        self.assertEquals(requests.value(('2-legged', 'rejected')), 2)
+        self.assertEquals(metrics.get('oauth_authenticate_seconds').value(
+            ('2-legged',))[0], 4)
+        failures = metrics.get('oauth_validator_failures_total')
+        self.assertEquals(failures.value(('_verify_request',)), 1)
+        self.assertEquals(failures.value(('_get_consumer',)), 1)
+        # The manager statistics
+        self.assertEquals(manager.consumer_cache.hits, 2)
+        self.assertTrue(metrics.get('oauth_db_query_seconds').value(
+            ('SELECT',))[0] >= 2)
+
+        # The metrics are served on the metrics path
+        environ = self._makeEnviron({'PATH_INFO': '/metrics'})
+        self.assertEquals(plugin.identify(environ), None)
+        app = environ['repoze.who.application']
+        responses = []
+        body = ''.join(app(environ,
+            lambda status, headers: responses.append((status, headers))))
+        self.assertEquals(responses[0][0], '200 OK')
+        self.assertEquals(dict(responses[0][1])['Content-Type'],
+            'text/plain; version=0.0.4; charset=utf-8')
+        for line in (
+                'oauth_requests_total{type="2-legged",'
+                    'outcome="authenticated"} 2',
+                'oauth_cache_hits_total{cache="consumer"} 2',
+                'oauth_cache_hit_ratio{cache="consumer"} 0.5',
+                'oauth_authenticate_seconds_count{type="2-legged"} 4',
+                '# TYPE oauth_db_query_seconds histogram'):
+            self.assertTrue(line in body.splitlines(), line)
+
+    def _test_verify_request(self, plugin):
         # 2 legs - successful
         # Create an oauth consumer and oauth request without a token
         consumer = oauth2.Consumer('some-consumer', 'some-secret')
@@ -391,6 +807,10 @@ class TestOAuthPlugin(ManagerTester):
         }, consumer=consumer, identity=req)
         # Request verification successful
         self.assertTrue(plugin._verify_request(env))
+        # The constructed request is kept in the environ
+        from repoze.who.plugins.oauth import REQUEST_KEY
+        self.assertEquals(env['environ'][REQUEST_KEY]['oauth_signature'],
+            req['oauth_signature'])
 
         # 2 legs - unsuccessful
         # The request signature includes various parameters. If we change them
@@ -522,6 +942,12 @@ class TestOAuthPlugin(ManagerTester):
         rtoken = manager.create_request_token(consumer, 'oob')
         rtoken = manager.set_request_token_user(rtoken.key, u'some-user')
 
+        # A concurrent request holds the same request token
+        from repoze.who.plugins.oauth import RequestToken
+        other_env = dict(environ={}, identity={},
+            token=self.session.query(RequestToken).get(rtoken.key))
+        self.assertTrue(plugin._access_token_app(other_env))
+
         # The function needs nothing but the request token. And it does nothing
         # but assign the access token creation app to the environ
         env = dict(environ={}, token=rtoken, identity={})
@@ -540,6 +966,13 @@ class TestOAuthPlugin(ManagerTester):
         # And the token secret matches
         self.assertEquals(dec_token['oauth_token_secret'][0], token.secret)
 
+        # The request token can not be exchanged twice
+        statuses = []
+        other_app = other_env['environ']['repoze.who.application']
+        other_app(other_env['environ'],
+            lambda status, *args: statuses.append(status))
+        self.assertTrue(statuses[0].startswith('401'))
+
         # Cleanup
         manager.DBSession.delete(consumer)
         manager.DBSession.flush()
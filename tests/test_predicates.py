@@ -224,6 +224,13 @@ class TestTokenAuthorization(BasePredicateTester):
         # query string parameters
         self.assertEquals(env['repoze.what.oauth']['token'], token)
 
+        # The parameters parsed by the repoze.who plugin are reused
+        from repoze.who.plugins.oauth import PARAMS_KEY
+        env = self._make_environ()
+        env[PARAMS_KEY] = {'oauth_token': 'some-token'}
+        self.eval_met_predicate(p, env)
+        self.assertEquals(env['repoze.what.oauth']['token'], token)
+
         # Now construct a POST query and expect to find a callback function to
         # authorize the request token
         env = self._make_environ()
@@ -241,5 +248,6 @@ class TestTokenAuthorization(BasePredicateTester):
         # If the token callback url was provided as 'oob' (out of band) then the
         # callback['url'] should also specify oob
         token.callback = u'oob'
+        session.flush()
         callback = callback_maker('some-token', u'some-user')
         self.assertEquals(callback['url'], 'oob')
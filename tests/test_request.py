@@ -0,0 +1,138 @@
+import random
+import unittest
+
+import oauth2
+from paste.request import construct_url
+
+
+class TestBaseString(unittest.TestCase):
+    r"""Tests for the native signature base string builder"""
+
+    # The characters to build the test vectors of: unreserved, reserved,
+    # escaping related and non-ascii ones
+    alphabet = [u'a', u'Z', u'0', u'-', u'.', u'_', u'~', u' ', u'+', u'%',
+        u'%20', u'&', u'=', u'/', u'?', u'#', u':', u'@', u'!', u'*', u"'",
+        u'(', u')', u'"', u',', u';', u'\xe9', u'\u2603', u'\U0001d11e']
+
+    def _random_string(self, rand, max_length=8, encoded=False):
+        s = u''.join([rand.choice(self.alphabet)
+            for i in xrange(rand.randint(0, max_length))])
+        # Both unicode and utf-8 encoded strings are accepted
+        if encoded or rand.random() < 0.5:
+            s = s.encode('utf-8')
+        return s
+
+    def _random_parameters(self, rand):
+        params = {}
+        for i in xrange(rand.randint(0, 10)):
+            key = rand.choice([
+                'oauth_consumer_key', 'oauth_token', 'oauth_nonce',
+                'oauth_signature', 'realm', 'a', 'a2', 'b5',
+                # The parsed parameter names are byte strings
+                self._random_string(rand, 4, encoded=True) or 'x'])
+            if rand.random() < 0.2:
+                # A repeated parameter
+                params[key] = [self._random_string(rand)
+                    for j in xrange(rand.randint(1, 3))]
+            else:
+                params[key] = self._random_string(rand)
+        return params
+
+    def _random_environ(self, rand):
+        scheme = rand.choice(['http', 'https'])
+        environ = {
+            'REQUEST_METHOD': rand.choice(['GET', 'POST', 'PUT', 'DELETE']),
+            'wsgi.url_scheme': scheme,
+            'SERVER_NAME': rand.choice(['www.example.com', 'localhost']),
+            'SERVER_PORT': rand.choice(['80', '443', '8080']),
+            'SCRIPT_NAME': rand.choice(['', '/app', '/my app']),
+            'PATH_INFO': rand.choice(['', '/', '/some/path', '/a b/c~d',
+                '/caf\xc3\xa9', '/x%2Fy', '/q?s']),
+        }
+        if rand.random() < 0.5:
+            environ['HTTP_HOST'] = rand.choice(['example.com',
+                'example.com:80', 'example.com:443', 'example.com:8080',
+                'example.com:'])
+        return environ
+
+    def test_escape(self):
+        r"""Test the percent-encoding"""
+        from repoze.who.plugins.oauth.request import escape
+        self.assertEquals(escape('abc-._~XYZ019'), 'abc-._~XYZ019')
+        self.assertEquals(escape('a b+c/%'), 'a%20b%2Bc%2F%25')
+        self.assertEquals(escape(u'\xe9'), '%C3%A9')
+        self.assertEquals(escape(''), '')
+        rand = random.Random(0)
+        for i in xrange(1000):
+            s = self._random_string(rand, 20)
+            self.assertEquals(escape(s), oauth2.escape(s))
+
+    def test_rfc5849_example(self):
+        r"""Test the base string of the RFC 5849 (3.4.1.1) example.
+        Like oauth2 the parameters are sorted before they are encoded, so 'c2'
+        goes before 'c@' (RFC sorts 'c%40' before 'c2')
+        """
+        from repoze.who.plugins.oauth.request import Request
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'wsgi.url_scheme': 'http',
+            'HTTP_HOST': 'example.com',
+            'PATH_INFO': '/request',
+        }
+        req = Request.from_environ(environ, {
+            'b5': '=%3D',
+            'a3': ['a', '2 q'],
+            'c@': '',
+            'a2': 'r b',
+            'c2': '',
+            'oauth_consumer_key': '9djdj82h48djs9d2',
+            'oauth_token': 'kkk9d7dh3k39sjv7',
+            'oauth_signature_method': 'HMAC-SHA1',
+            'oauth_timestamp': '137131201',
+            'oauth_nonce': '7d8f3e4a',
+            'oauth_signature': 'bYT5CMsGcbgUdFHObYMEfcx6bsw=',
+        })
+        key, raw = oauth2.SignatureMethod_HMAC_SHA1().signing_base(req,
+            oauth2.Consumer('9djdj82h48djs9d2', 'j49sk3j29djd'),
+            oauth2.Token('kkk9d7dh3k39sjv7', 'dh893hdasih9'))
+        self.assertEquals(raw, 'POST&http%3A%2F%2Fexample.com%2Frequest&a2%3Dr'
+            '%2520b%26a3%3D2%2520q%26a3%3Da%26b5%3D%253D%25253D%26c2%3D'
+            '%26c%2540%3D'
+            '%26oauth_consumer_key%3D9djdj82h48djs9d2%26oauth_nonce%3D7d8'
+            'f3e4a%26oauth_signature_method%3DHMAC-SHA1%26oauth_timestamp%3D13'
+            '7131201%26oauth_token%3Dkkk9d7dh3k39sjv7')
+
+    def test_oauth2_compatibility(self):
+        r"""Test that the base strings are byte identical to the ones of oauth2
+        on a corpus of random requests"""
+        from repoze.who.plugins.oauth.request import (Request,
+            signature_base_string)
+        consumer = oauth2.Consumer('some-consumer', 'some-secret')
+        method = oauth2.SignatureMethod_HMAC_SHA1()
+        rand = random.Random(0)
+        for i in xrange(5000):
+            environ = self._random_environ(rand)
+            params = self._random_parameters(rand)
+            expected = oauth2.Request(method=environ['REQUEST_METHOD'],
+                url=construct_url(environ, with_query_string=False),
+                parameters=params)
+            req = Request.from_environ(environ, params)
+            self.assertEquals(req.normalized_url, expected.normalized_url)
+            self.assertEquals(req.get_normalized_parameters(),
+                expected.get_normalized_parameters())
+            self.assertEquals(method.signing_base(req, consumer, None),
+                method.signing_base(expected, consumer, None))
+            self.assertEquals(method.sign(req, consumer, None),
+                method.sign(expected, consumer, None))
+            self.assertEquals(signature_base_string(req.method,
+                    req.normalized_url, req.get_normalized_parameters()),
+                method.signing_base(expected, consumer, None)[1])
+
+    def test_unsupported_scheme(self):
+        r"""Test that only http and https urls are accepted"""
+        from repoze.who.plugins.oauth.request import normalized_url
+        self.assertRaises(ValueError, normalized_url, {
+            'wsgi.url_scheme': 'ftp',
+            'SERVER_NAME': 'example.com',
+            'SERVER_PORT': '21',
+        })
@@ -0,0 +1,253 @@
+import unittest
+
+import oauth2
+
+
+class TestVerifier(unittest.TestCase):
+    r"""Tests for the native request verifier"""
+
+    def _makeOne(self):
+        from repoze.who.plugins.oauth.signatures import (
+            SignatureMethod_HMAC_SHA1)
+        from repoze.who.plugins.oauth.verifier import Verifier
+        # Control the time
+        self.now = 1000000000.0
+        return Verifier(signature_methods={
+            'HMAC-SHA1': SignatureMethod_HMAC_SHA1(),
+        }, timer=lambda: self.now)
+
+    def _makeRequest(self, consumer, token=None, **params):
+        from repoze.who.plugins.oauth.request import Request
+        req = oauth2.Request.from_consumer_and_token(consumer, token,
+            http_method='GET', http_url='http://www.example.com/app')
+        req['oauth_timestamp'] = str(int(self.now))
+        req.update(params)
+        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), consumer, token)
+        return Request('GET', 'http://www.example.com/app', req)
+
+    def test_compare_digest(self):
+        r"""Test the constant time comparison fallback"""
+        from repoze.who.plugins.oauth.verifier import _compare_digest
+        self.assertTrue(_compare_digest('abc', 'abc'))
+        self.assertTrue(_compare_digest('', ''))
+        self.assertFalse(_compare_digest('abc', 'abd'))
+        self.assertFalse(_compare_digest('abc', 'ab'))
+
+    def test_signature_method(self):
+        r"""Test that the native HMAC-SHA1 signs like the oauth2 one"""
+        from repoze.who.plugins.oauth.signatures import (
+            SignatureMethod_HMAC_SHA1)
+        consumer = oauth2.Consumer('some-consumer', u'some secret')
+        token = oauth2.Token('some-token', 'some&secret')
+        self.now = 1000000000.0
+        req = self._makeRequest(consumer, token, x=u'\xe9 1')
+        for tok in (None, token):
+            self.assertEquals(
+                SignatureMethod_HMAC_SHA1().signing_base(req, consumer, tok),
+                oauth2.SignatureMethod_HMAC_SHA1().signing_base(req, consumer,
+                    tok))
+
+    def test_hmac_key_cache(self):
+        r"""Test that the keyed HMAC objects are reused per secret pair"""
+        from repoze.who.plugins.oauth.signatures import (
+            SignatureMethod_HMAC_SHA1)
+        method = SignatureMethod_HMAC_SHA1(key_cache_size=2)
+        consumer = oauth2.Consumer('some-consumer', 'some-secret')
+        token = oauth2.Token('some-token', 'token-secret')
+        self.now = 1000000000.0
+        req = self._makeRequest(consumer, token)
+        expected = oauth2.SignatureMethod_HMAC_SHA1()
+        for i in xrange(3):
+            for tok in (token, None):
+                self.assertEquals(method.sign(req, consumer, tok),
+                    expected.sign(req, consumer, tok))
+        # Two secret pairs, four hits
+        self.assertEquals(len(method.keys), 2)
+        self.assertEquals((method.keys.hits, method.keys.misses), (4, 2))
+        # A changed secret gets a new key
+        token.secret = 'other-secret'
+        self.assertEquals(method.sign(req, consumer, token),
+            expected.sign(req, consumer, token))
+        self.assertEquals(len(method.keys), 2)
+        self.assertEquals(method.keys.misses, 3)
+
+        # The cache can be disabled
+        method = SignatureMethod_HMAC_SHA1(key_cache_size=0)
+        self.assertEquals(method.sign(req, consumer, token),
+            expected.sign(req, consumer, token))
+        self.assertEquals(len(method.keys), 0)
+
+    def test_check_request(self):
+        r"""Test the version, timestamp and signature checks"""
+        verifier = self._makeOne()
+        consumer = oauth2.Consumer('some-consumer', 'some-secret')
+        token = oauth2.Token('some-token', 'token-secret')
+        req = self._makeRequest(consumer, token)
+        self.assertTrue(verifier.check_request(req, consumer, token))
+        # oauth2.Server compatible verification
+        self.assertEquals(verifier.verify_request(req, consumer, token), {})
+
+        # Wrong secrets
+        self.assertFalse(verifier.check_request(req,
+            oauth2.Consumer('some-consumer', 'other-secret'), token))
+        self.assertFalse(verifier.check_request(req, consumer, None))
+        self.assertRaises(oauth2.Error, verifier.verify_request, req,
+            consumer, None)
+
+        # The version is optional but must match if given
+        self.assertTrue(verifier.check_request(
+            self._makeRequest(consumer, token, oauth_version=''),
+            consumer, token))
+        self.assertFalse(verifier.check_request(
+            self._makeRequest(consumer, token, oauth_version='2.0'),
+            consumer, token))
+
+        # Expired timestamps are rejected
+        self.now += 300
+        self.assertTrue(verifier.check_request(req, consumer, token))
+        self.now += 1
+        self.assertFalse(verifier.check_request(req, consumer, token))
+
+        # So are missing or malformed ones, missing nonces, signatures and
+        # unsupported signature methods
+        for key, value in (
+                ('oauth_timestamp', None),
+                ('oauth_timestamp', 'abc'),
+                ('oauth_timestamp', '-1'),
+                ('oauth_nonce', None),
+                ('oauth_signature', None),
+                ('oauth_signature_method', None),
+                ('oauth_signature_method', 'PLAINTEXT')):
+            req = self._makeRequest(consumer, token)
+            if value is None:
+                del req[key]
+            else:
+                req[key] = value
+            self.assertFalse(verifier.check_request(req, consumer, token), key)
+
+    def test_signature_method_check(self):
+        r"""Test that the signature methods checking the signature themselves
+        are used as they are"""
+        class Method(oauth2.SignatureMethod):
+            name = 'CUSTOM'
+
+            def check(self, request, consumer, token, signature):
+                return signature == 'valid'
+
+        verifier = self._makeOne()
+        verifier.add_signature_method(Method())
+        consumer = oauth2.Consumer('some-consumer', 'some-secret')
+        req = self._makeRequest(consumer)
+        req['oauth_signature_method'] = 'CUSTOM'
+        self.assertFalse(verifier.check_request(req, consumer, None))
+        req['oauth_signature'] = 'valid'
+        self.assertTrue(verifier.check_request(req, consumer, None))
+
+    def test_rsa_keys(self):
+        r"""Test that the RSA keys are imported once and the padding is computed
+        once per key size"""
+        from repoze.who.plugins.oauth import signatures
+
+        class Key(object):
+            def __init__(self, n):
+                self.n = n
+
+        class RSA(object):
+            imported = []
+
+            @classmethod
+            def importKey(cls, pem):
+                cls.imported.append(pem)
+                return Key(int(pem))
+
+        orig_rsa, signatures.RSA = signatures.RSA, RSA
+        try:
+            method = signatures.SignatureMethod_RSA_SHA1(key_cache_size=2)
+            consumer = oauth2.Consumer('some-consumer', 'some-secret')
+            consumer.rsa_key = str(2 ** 1023)
+            key = method._get_key(consumer)
+            self.assertEquals(key.n, 2 ** 1023)
+            self.assertTrue(method._get_key(consumer) is key)
+            self.assertEquals(RSA.imported, [consumer.rsa_key])
+
+            # Without rsa_key the secret is the key if it is a key object
+            del consumer.rsa_key
+            self.assertEquals(method._get_key(consumer), None)
+            consumer.secret = key
+            self.assertTrue(method._get_key(consumer) is key)
+        finally:
+            signatures.RSA = orig_rsa
+
+        # The emsa-pkcs1-v1_5 encoding of a 1024 bit key
+        digest = 'x' * 20
+        data = method._pkcs1imify(key, digest)
+        self.assertEquals(len(data), 128)
+        self.assertEquals(data, '\x00\x01' + '\xff' * 90 + '\x00' +
+            signatures.SHA1_DIGESTINFO + digest)
+        self.assertTrue((128, 20) in method._prefixes)
+        self.assertEquals(method._pkcs1imify(key, digest), data)
+
+    def test_rsa_check_failures(self):
+        r"""Test that the RSA-SHA1 check fails instead of raising without a
+        key, backend or a decodable signature"""
+        from repoze.who.plugins.oauth import signatures
+
+        class Key(object):
+            n, e = 3233, 17
+
+            def verify(self, data, signature):
+                return True
+
+        consumer = oauth2.Consumer('some-consumer', u'some-secret')
+        self.now = 1000000000.0
+        req = self._makeRequest(consumer)
+        method = signatures.SignatureMethod_RSA_SHA1()
+        orig_rsa, signatures.RSA = signatures.RSA, object()
+        try:
+            # A plain secret is not a key
+            self.assertFalse(method.check(req, consumer, None, 'AAAA'))
+            consumer.secret = Key()
+            self.assertTrue(method.check(req, consumer, None, 'AAAA'))
+            # Not base64
+            self.assertFalse(method.check(req, consumer, None, 'AAA'))
+            # No RSA backend
+            signatures.RSA = None
+            self.assertFalse(method.check(req, consumer, None, 'AAAA'))
+        finally:
+            signatures.RSA = orig_rsa
+
+    def test_signature_errors(self):
+        r"""Test that the signature and key errors fail the check"""
+        from repoze.who.plugins.oauth import signatures
+        from repoze.who.plugins.oauth.verifier import Verifier
+
+        class Method(oauth2.SignatureMethod):
+            name = 'BROKEN'
+
+            def check(self, request, consumer, token, signature):
+                raise ValueError(signature)
+
+        self.now = 1000000000.0
+        verifier = Verifier(signature_methods={
+            'RSA-SHA1': signatures.SignatureMethod_RSA_SHA1(),
+            'BROKEN': Method(),
+        }, timer=lambda: self.now)
+        # A consumer without an RSA key
+        consumer = oauth2.Consumer('some-consumer', u'some-secret')
+        req = self._makeRequest(consumer)
+        orig_rsa, signatures.RSA = signatures.RSA, object()
+        try:
+            for method, signature in (('RSA-SHA1', 'AAAA'),
+                    ('RSA-SHA1', 'AAA'), ('BROKEN', 'AAAA')):
+                req['oauth_signature_method'] = method
+                req['oauth_signature'] = signature
+                self.assertFalse(verifier.check_request(req, consumer, None))
+                self.assertRaises(oauth2.Error, verifier.verify_request, req,
+                    consumer, None)
+            # Malformed RSA-SHA1 signatures fail even with a key
+            consumer.secret = type('Key', (object,), dict(n=3233, e=17))()
+            req['oauth_signature_method'] = 'RSA-SHA1'
+            req['oauth_signature'] = 'AAA'
+            self.assertFalse(verifier.check_request(req, consumer, None))
+        finally:
+            signatures.RSA = orig_rsa